@@ -0,0 +1,300 @@
+"""
+Бенчмарк генератора XML без доступу до Google.
+
+Підставляє в main.sheets_api httpx-транспорт FakeSheetsClient, який відповідає на запити
+Sheets API v4 (метадані, values:batchGet, values/{range}) і Drive API (modifiedTime) з даних у пам'яті
+із затримкою та імітацією помилок 429, після чого проганяє create_xml і повний цикл оновлення
+на синтетичних постачальниках.
+
+Запуск:
+    python benchmark.py --rows 1000,10000,100000 --suppliers 20 --supplier-rows 5000
+    python benchmark.py --rows 1000000 --latency 0.2 --error-rate 0.05 --json bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import httpx
+from google.oauth2.credentials import Credentials
+
+MASTER_HEADER = [
+    "Post_ID", "Supplier Name", "Google Sheet ID", "ID Column", "Name Column", "Stock Column",
+    "Price Column", "SKU Column", "RRP Column", "Currency Column"
+]
+SUPPLIER_COLUMNS = ["A", "B", "C", "D", "E", "F", "G"]
+ROWS_PER_WORKSHEET = 50000
+
+
+# 🔹 Локальна заміна Google Sheets
+class FakeWorksheet:
+    def __init__(self, title, rows):
+        self.title = title
+        self.rows = rows
+
+
+class FakeSpreadsheet:
+    def __init__(self, key, worksheets):
+        self.id = key
+        self._worksheets = worksheets
+        self.modified_time = "2026-01-01T00:00:00.000Z"
+
+    @property
+    def sheet1(self):
+        return self._worksheets[0]
+
+    def worksheet_rows(self, range_name):
+        """ Рядки аркуша за діапазоном виду 'Назва' (як його формує absolute_range_name) """
+        title = range_name[1:-1].replace("''", "'") if range_name.startswith("'") else range_name
+        for sheet in self._worksheets:
+            if sheet.title == title:
+                return [list(row) for row in sheet.rows]
+        return None
+
+
+class FakeSheetsClient:
+    """
+    Google Sheets і Drive API з даними в пам'яті; transport() підключається до main.sheets_api.
+    - latency — затримка кожного виклику API (сек.)
+    - error_rate — частка викликів, що завершуються помилкою 429
+    Лічильник calls показує кількість викликів API за методами.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, seed=42):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.spreadsheets = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        """ Рахує виклик; повертає True, якщо цей виклик має завершитися помилкою 429 """
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            return bool(self.error_rate and self.random.random() < self.error_rate)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+    def add_spreadsheet(self, key, worksheets):
+        self.spreadsheets[key] = FakeSpreadsheet(key, [FakeWorksheet(title, rows) for title, rows in worksheets])
+        return self.spreadsheets[key]
+
+    def open_by_key(self, key):
+        """ Таблиця за ключем; невідома (наприклад, головна) створюється з порожнім аркушем "Sheet1" """
+        if key not in self.spreadsheets:
+            self.add_spreadsheet(key, [("Sheet1", [list(MASTER_HEADER)])])
+        return self.spreadsheets[key]
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request):
+        """ Відповідає на запит httpx так само, як Google API """
+        parts = request.url.path.strip("/").split("/")
+        if request.url.host == "www.googleapis.com":  # drive/v3/files/{id}
+            method, key = "get_file_drive_metadata", parts[3]
+        elif parts[-1].endswith(":batchGet"):  # v4/spreadsheets/{id}/values:batchGet
+            method, key = "values_batch_get", parts[2]
+        elif len(parts) > 3:  # v4/spreadsheets/{id}/values/{range}
+            method, key = "values_get", parts[2]
+        else:  # v4/spreadsheets/{id}
+            method, key = "fetch_sheet_metadata", parts[2]
+
+        fail = self.call(method)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if fail:
+            return httpx.Response(429, headers={"Retry-After": "1"}, json={"error": {"code": 429, "message": "Quota exceeded for quota metric 'Read requests' (simulated)", "status": "RESOURCE_EXHAUSTED"}})
+        spreadsheet = self.spreadsheets.get(key)
+        if spreadsheet is None:
+            return httpx.Response(404, json={"error": {"code": 404, "message": "Requested entity was not found.", "status": "NOT_FOUND"}})
+
+        if method == "get_file_drive_metadata":
+            return httpx.Response(200, json={"id": key, "modifiedTime": spreadsheet.modified_time})
+        if method == "fetch_sheet_metadata":
+            return httpx.Response(200, json={"sheets": [{"properties": {"title": sheet.title}} for sheet in spreadsheet._worksheets]})
+        ranges = request.url.params.get_list("ranges") if method == "values_batch_get" else [urllib.parse.unquote(parts[4])]
+        value_ranges = []
+        for range_name in ranges:
+            rows = spreadsheet.worksheet_rows(range_name)
+            if rows is None:
+                return httpx.Response(400, json={"error": {"code": 400, "message": f"Unable to parse range: {range_name}", "status": "INVALID_ARGUMENT"}})
+            value_ranges.append({"range": range_name, "values": rows})
+        if method == "values_get":
+            return httpx.Response(200, json=value_ranges[0])
+        return httpx.Response(200, json={"valueRanges": value_ranges})
+
+
+class FakeCredentials:
+    valid = True
+    expired = False
+    refresh_token = "fake"
+    token = "fake"
+    expiry = None
+
+    def apply(self, headers):
+        headers["authorization"] = f"Bearer {self.token}"
+
+
+# 🔹 Синтетичні дані
+def make_supplier_rows(row_count, seed=0):
+    """ Генерує аркуші постачальника (по ROWS_PER_WORKSHEET рядків) з типовими брудними даними """
+    rnd = random.Random(seed)
+    worksheets = []
+    for start in range(0, max(row_count, 1), ROWS_PER_WORKSHEET):
+        rows = [["ID", "Назва", "Наявність", "Ціна", "Артикул", "РРЦ", "Валюта"]]
+        for i in range(start, min(start + ROWS_PER_WORKSHEET, row_count)):
+            rows.append([
+                f"P{seed}-{i}",
+                f"Товар {i} <{rnd.choice(['A', 'B', 'C'])}> & Co",
+                rnd.choice(["", "-", "5", "12,0", "є", "немає"]),
+                rnd.choice([f"{rnd.randint(1, 50000)},{rnd.randint(0, 99):02d} грн", f"{rnd.randint(1, 9)} {rnd.randint(100, 999)}", "0", ""]),
+                f"SKU-{i}" if rnd.random() < 0.8 else "",
+                f"{rnd.randint(1, 60000)}" if rnd.random() < 0.5 else "",
+                rnd.choice(["UAH", "USD", ""]),
+            ])
+        worksheets.append((f"Аркуш{len(worksheets) + 1}", rows))
+    return worksheets
+
+
+def supplier_columns():
+    return dict(zip(["ID", "Name", "Stock", "Price", "SKU", "RRP", "Currency"], SUPPLIER_COLUMNS))
+
+
+def peak_rss_mb():
+    """ Пікове RSS процесу (Linux повертає KiB) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# 🔹 Підготовка середовища та імпорт main.py з підміненим клієнтом
+def load_app(fake_client, workdir):
+    for name in ("output", "logs", "state"):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    os.environ["XML_DIR"] = os.path.join(workdir, "output")
+    os.environ["LOG_DIR"] = os.path.join(workdir, "logs")
+    os.environ["STATE_DIR"] = os.path.join(workdir, "state")
+    os.environ.setdefault("GOOGLE_CREDENTIALS", json.dumps({"installed": {}}))
+    os.environ.setdefault("TOKEN_JSON", json.dumps({"token": "fake", "refresh_token": "fake"}))
+    os.environ.setdefault("SHEETS_REQUESTS_PER_MINUTE", "1000000")
+
+    Credentials.from_authorized_user_info = classmethod(lambda cls, *args, **kwargs: FakeCredentials())
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.sheets_api.transport = fake_client.transport()
+    return main
+
+
+# 🔹 Сценарії
+def bench_create_xml(main, fake_client, row_counts):
+    """ create_xml для одного постачальника різного розміру """
+    results = []
+    for index, row_count in enumerate(sorted(row_counts)):
+        supplier_id = f"bench{row_count}"
+        fake_client.add_spreadsheet(supplier_id, make_supplier_rows(row_count, seed=index))
+        fake_client.reset_calls()
+        log_filename = main.get_log_filename()
+
+        started_at = time.perf_counter()
+        main.create_xml(supplier_id, supplier_id, supplier_id, supplier_columns(), log_filename)
+        elapsed = time.perf_counter() - started_at
+        main.close_run_logger(log_filename)
+
+        results.append({
+            "scenario": "create_xml",
+            "rows": row_count,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(row_count / elapsed) if elapsed else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "api_calls": fake_client.total_calls(),
+        })
+    return results
+
+
+def bench_cycle(main, fake_client, supplier_count, supplier_rows, changed_share):
+    """ Повний цикл оновлення: холодний старт, тепле повторення і цикл зі зміненою частиною постачальників """
+    master = [MASTER_HEADER]
+    for i in range(supplier_count):
+        key = f"cycle{i}"
+        fake_client.add_spreadsheet(key, make_supplier_rows(supplier_rows, seed=1000 + i))
+        master.append([str(10000 + i), f"Постачальник {i}", key] + SUPPLIER_COLUMNS)
+    fake_client.open_by_key(main.MASTER_SHEET_ID).sheet1.rows = master
+
+    results = []
+    for label in ("cold", "warm", "changed"):
+        if label == "changed":
+            for i in range(int(supplier_count * changed_share)):
+                spreadsheet = fake_client.spreadsheets[f"cycle{i}"]
+                spreadsheet._worksheets[0].rows[1][3] = str(random.randint(1, 99999))
+                spreadsheet.modified_time = f"2026-01-02T00:00:{i % 60:02d}.000Z"
+
+        fake_client.reset_calls()
+        started_at = time.perf_counter()
+        summary = asyncio.run(main.run_update_cycle(check_all=True))
+        elapsed = time.perf_counter() - started_at
+
+        results.append({
+            "scenario": f"cycle_{label}",
+            "suppliers": supplier_count,
+            "rows": supplier_count * supplier_rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(supplier_count * supplier_rows / elapsed) if elapsed else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "api_calls": fake_client.total_calls(),
+            "summary": summary,
+        })
+    return results
+
+
+def print_results(results):
+    print(f"{'сценарій':<16}{'рядків':>10}{'сек.':>10}{'рядків/с':>12}{'RSS, МБ':>10}{'API':>8}")
+    for result in results:
+        print(
+            f"{result['scenario']:<16}{result['rows']:>10}{result['seconds']:>10.3f}"
+            f"{result['rows_per_second'] or 0:>12}{result['peak_rss_mb']:>10.1f}{result['api_calls']:>8}"
+        )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк генерації XML з локальною заміною Google Sheets")
+    parser.add_argument("--rows", default="1000,10000,100000", help="Розміри постачальників для create_xml, через кому")
+    parser.add_argument("--suppliers", type=int, default=20, help="Кількість постачальників у циклі оновлення")
+    parser.add_argument("--supplier-rows", type=int, default=5000, help="Рядків у кожного постачальника циклу")
+    parser.add_argument("--changed-share", type=float, default=0.2, help="Частка постачальників, змінених перед третім циклом")
+    parser.add_argument("--latency", type=float, default=0.0, help="Затримка кожного виклику API, сек.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Частка викликів API з помилкою 429")
+    parser.add_argument("--workdir", help="Каталог для output/logs/state (за замовчуванням — тимчасовий)")
+    parser.add_argument("--json", dest="json_path", help="Зберегти результати у JSON (базова лінія для порівняння)")
+    args = parser.parse_args()
+
+    fake_client = FakeSheetsClient(latency=args.latency, error_rate=args.error_rate)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="xml-bench-")
+    main = load_app(fake_client, workdir)
+
+    row_counts = [int(value) for value in args.rows.split(",") if value.strip()]
+    results = bench_create_xml(main, fake_client, row_counts)
+    if args.suppliers:
+        results += bench_cycle(main, fake_client, args.suppliers, args.supplier_rows, args.changed_share)
+
+    print_results(results)
+    print(f"Файли: {workdir}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
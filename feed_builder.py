@@ -0,0 +1,411 @@
+"""
+Побудова фідів без побічних ефектів під час імпорту: нормалізація рядків, експортери форматів,
+запис фідів і стиснутих копій. Модуль не звертається ні до Google Sheets, ні до сховища стану
+чи логів, тож його імпортують процеси пулів побудови замість main.py (для них він попередньо
+завантажується у forkserver). DEBUG-записи передаються через log(повідомлення) — у процесі
+пулу вони накопичуються та повертаються головному процесу разом із результатом.
+"""
+import os
+import io
+import csv
+import json
+import re
+import time
+import itertools
+import collections
+import hashlib
+import gzip
+import shutil
+import tempfile
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import brotli  # Необов'язково: без нього фіди стискаються лише в gzip
+except ImportError:
+    brotli = None
+
+# 🔹 Конфігурація побудови
+COMPRESSED_EXTENSIONS = {"br": "br", "gzip": "gz"}  # Кодування у порядку переваги -> розширення копії
+BROTLI_QUALITY = 9  # 11 стискає краще, але надто повільно для великих фідів
+DEFAULT_FORMATS = ("xml",)
+
+# 🔹 Попередньо скомпільовані шаблони нормалізації
+PRICE_CLEAN_RE = re.compile(r"[^\d,\.\x1f]")  # \x1f — роздільник значень при пакетній обробці колонки
+STOCK_NUMBER_RE = re.compile(r"^\d+([.,]\d+)?$")  # Число з комою або крапкою
+VALUE_SEPARATOR = "\x1f"
+NORMALIZE_BATCH_SIZE = 5000  # Скільки рядків нормалізувати за один прохід по колонках
+
+
+def column_index(column_letter):
+    """ Переводить літеру колонки в індекс: A -> 0, Z -> 25, AA -> 26, AB -> 27 ... """
+    index = 0
+    for char in column_letter.upper():
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def compile_columns(columns):
+    """ Один раз на постачальника перетворює літери колонок на індекси (None — колонки немає) """
+    return {
+        field: column_index(letter.strip()) if letter and letter.strip().isalpha() else None
+        for field, letter in columns.items()
+    }
+
+
+# 🔹 Пакетна (по колонках) нормалізація рядків
+def extract_column(rows, index, default_value="-"):
+    """ Витягує одну колонку з пачки рядків: значення без зайвих пробілів або default_value, якщо комірка порожня чи її немає """
+    if index is None:
+        return [default_value] * len(rows)
+    return [(str(row[index]).strip() or default_value) if len(row) > index else default_value for row in rows]
+
+
+def clean_price_column(values):
+    """
+    Очищає цілу колонку цін одним викликом регулярного виразу:
+    значення склеюються через VALUE_SEPARATOR, чистяться й розділяються назад.
+    """
+    # Роздільник у самій комірці зсунув би ціни всіх наступних рядків, тож спершу прибираємо його зі значень
+    cleaned = PRICE_CLEAN_RE.sub("", VALUE_SEPARATOR.join(value.replace(VALUE_SEPARATOR, "") for value in values)).split(VALUE_SEPARATOR)
+    return [
+        (value.split(",", 1)[0] if "," in value else value.split(".", 1)[0]) or "0"
+        for value in cleaned
+    ]
+
+
+def normalize_stock_column(values):
+    """ Нормалізує колонку наявності: порожньо/"-" -> "0", числа -> ціле, текст ("є", "true") — як є """
+    result = []
+    for raw_stock in values:
+        if raw_stock in ("", "-"):
+            result.append("0")
+        elif STOCK_NUMBER_RE.match(raw_stock):
+            result.append(str(int(float(raw_stock.replace(",", ".")))))
+        else:
+            result.append(raw_stock)
+    return result
+
+
+# 🔹 Функція генерації XML
+# 🔹 Функція для створення XML
+
+def iter_products(rows, columns, counters, log=None):
+    """
+    Перевіряє рядки таблиці та по одному повертає словники товарів.
+    Рядки нормалізуються пачками по NORMALIZE_BATCH_SIZE: колонки визначаються один раз,
+    а ціни/наявність обробляються цілими колонками.
+    Кількість доданих/пропущених товарів рахується в counters.
+    Рядок на кожен товар передається в log лише тоді, коли його задано (рівень DEBUG).
+    """
+    debug = log is not None
+    indexes = compile_columns(columns)
+    rows = iter(rows)
+
+    while True:
+        batch = list(itertools.islice(rows, NORMALIZE_BATCH_SIZE))
+        if not batch:
+            break
+
+        product_ids = extract_column(batch, indexes.get("ID"))
+        names = extract_column(batch, indexes.get("Name"))
+        prices = clean_price_column(extract_column(batch, indexes.get("Price"), "0"))
+
+        # 🔹 Обробка поля stock (наявність)
+        if indexes.get("Stock") is not None:
+            stocks = normalize_stock_column(extract_column(batch, indexes["Stock"]))
+        else:
+            stocks = ["true"] * len(batch)
+
+        skus = extract_column(batch, indexes.get("SKU"))
+        rrps = clean_price_column(extract_column(batch, indexes.get("RRP")))
+        currencies = extract_column(batch, indexes.get("Currency"), "UAH")
+
+        for product_id, name, price, stock, sku, rrp, currency in zip(product_ids, names, prices, stocks, skus, rrps, currencies):
+            # 🔴 Пропуск товарів без ID, Name або з ціною ≤ 0 (чи нерозпізнаною, як "1.234")
+            if not product_id or not name or not price.isdigit() or int(price) <= 0:
+                if debug:
+                    log(f"❌ Пропускаємо товар (некоректні дані або ціна = 0): id='{product_id}', name='{name}', price='{price}'")
+                counters["skipped"] += 1
+                continue
+
+            if debug:
+                log(f"✅ Додаємо товар: id='{product_id}', name='{name}', price='{price}', stock='{stock}'")
+            counters["processed"] += 1
+
+            yield {
+                "id": product_id,
+                "name": name,
+                "stock": stock,
+                "price": price,
+                "currency": currency,
+                "sku": sku,
+                "rrp": rrp,
+            }
+
+def render_product_xml(product):
+    """ Серіалізує один товар у фрагмент <product>...</product> """
+    parts = ["<product>"]
+    for tag in ("id", "name", "stock", "price", "currency"):
+        parts.append(f"<{tag}>{xml_escape(product[tag])}</{tag}>")
+
+    if product["sku"]:
+        parts.append(f"<sku>{xml_escape(product['sku'])}</sku>")
+    if product["rrp"] and product["rrp"] != "0":
+        parts.append(f"<rrp>{xml_escape(product['rrp'])}</rrp>")
+
+    parts.append("</product>")
+    return "".join(parts)
+
+
+# 🔹 Експортери фідів: кожен формат — заголовок, фрагмент на товар і завершення
+class XmlExporter:
+    """ Внутрішній формат <products><product> (як і раніше, {supplier_id}.xml) """
+    suffix = ".xml"
+
+    def header(self, supplier_id, supplier_name):
+        return "<?xml version='1.0' encoding='utf-8'?>\n<products>"
+
+    def item(self, product):
+        return render_product_xml(product)
+
+    def footer(self):
+        return "</products>"
+
+
+class CsvExporter:
+    """ CSV з заголовком; один буфер на експортер, щоб не створювати writer на кожен рядок """
+    suffix = ".csv"
+    fields = ("id", "name", "stock", "price", "currency", "sku", "rrp")
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+
+    def render(self, values):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerow(values)
+        return self.buffer.getvalue()
+
+    def header(self, supplier_id, supplier_name):
+        return self.render(self.fields)
+
+    def item(self, product):
+        return self.render([product[field] for field in self.fields])
+
+    def footer(self):
+        return ""
+
+
+class JsonLinesExporter:
+    """ JSON Lines: один товар — один JSON-рядок """
+    suffix = ".jsonl"
+
+    def header(self, supplier_id, supplier_name):
+        return ""
+
+    def item(self, product):
+        return json.dumps(product, ensure_ascii=False) + "\n"
+
+    def footer(self):
+        return ""
+
+
+# Реєстр форматів: новий формат — клас із suffix/header/item/footer і рядок тут
+EXPORTERS = {
+    "xml": XmlExporter,
+    "csv": CsvExporter,
+    "jsonl": JsonLinesExporter,
+}
+
+
+# 🔹 Запис фідів і стиснутих копій
+def compressed_path(path, encoding):
+    """ Шлях до стиснутої копії фіду (прихований файл поруч: .100.xml.gz / .100.xml.br) """
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, f".{filename}.{COMPRESSED_EXTENSIONS[encoding]}")
+
+
+def create_temp_file(target_path):
+    """
+    Унікальний тимчасовий файл поруч із target_path (.{ім'я}.XXXX.tmp) для атомарної підміни:
+    одночасні записи того самого файлу не перетинаються. Повертає (дескриптор, шлях).
+    """
+    directory, filename = os.path.split(target_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".tmp", dir=directory)
+    os.fchmod(fd, 0o644)  # mkstemp створює файл лише для власника, а фіди читає й веб-сервер
+    return fd, tmp_path
+
+
+def precompress_feed(path):
+    """ Один раз після генерації стискає фід у gzip і (якщо встановлено brotli) у br """
+    for encoding in COMPRESSED_EXTENSIONS:
+        if encoding == "br" and brotli is None:
+            continue
+        target_path = compressed_path(path, encoding)
+        fd, tmp_path = create_temp_file(target_path)
+        try:
+            with open(path, "rb") as src, open(fd, "wb") as dst:
+                if encoding == "gzip":
+                    with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=9, mtime=0) as gz:
+                        shutil.copyfileobj(src, gz, 1024 * 1024)
+                else:
+                    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+                    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                        dst.write(compressor.process(chunk))
+                    dst.write(compressor.finish())
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def write_feeds(target_paths, chunk_groups):
+    """
+    Записує кілька фідів за один прохід: chunk_groups видає кортежі фрагментів —
+    по одному на кожен шлях з target_paths. Для кожного фіду — атомарний запис
+    і стиснуті копії, щоб сервер не стискав файл на кожен запит.
+    Лише файлові операції (безпечно в пулі процесів); повертає {шлях: хеш вмісту для ETag},
+    зареєструвати який має головний процес.
+    """
+    tmp_paths = []
+    digests = [hashlib.sha1() for _ in target_paths]
+    files = []
+    try:
+        for target_path in target_paths:
+            fd, tmp_path = create_temp_file(target_path)
+            tmp_paths.append(tmp_path)
+            files.append(open(fd, "w", encoding="utf-8"))
+        outputs = list(zip(files, digests))
+        for chunks in chunk_groups:
+            for (f, digest), chunk in zip(outputs, chunks):
+                if chunk:
+                    f.write(chunk)
+                    digest.update(chunk.encode("utf-8"))
+        for f in files:
+            f.close()
+        for tmp_path, target_path in zip(tmp_paths, target_paths):
+            os.replace(tmp_path, target_path)
+    except BaseException:
+        for f in files:
+            f.close()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    etags = {}
+    for target_path, digest in zip(target_paths, digests):
+        precompress_feed(target_path)
+        etags[target_path] = digest.hexdigest()
+    return etags
+
+
+def iter_rendered(rows, columns, exporters, counters, products, timings, log=None):
+    """
+    Нормалізує рядки та серіалізує кожен товар усіма експортерами; видає кортежі фрагментів.
+    Знімок товарів, лічильники й час етапів накопичуються в products, counters і timings.
+    """
+    clock = time.perf_counter
+    product_iter = iter_products(rows, columns, counters, log)
+    while True:
+        started_at = clock()
+        product = next(product_iter, None)
+        rendered_at = clock()
+        timings["normalize"] += rendered_at - started_at
+        if product is None:
+            break
+        products[product["id"]] = product
+        chunks = tuple(exporter.item(product) for exporter in exporters)
+        timings["serialize"] += clock() - rendered_at
+        yield chunks
+
+def render_chunk(rows, columns, formats, debug=False):
+    """
+    Обробка однієї частини великого фіду в пулі процесів: перевірка та серіалізація рядків.
+    Повертає ([фрагмент на кожен формат], знімок товарів частини, лічильники, час етапів,
+    DEBUG-записи частини — їх пише в лог головний процес).
+    """
+    messages = []
+    exporters = [EXPORTERS[feed_format]() for feed_format in formats]
+    counters = {"processed": 0, "skipped": 0}
+    products = {}
+    timings = {"normalize": 0.0, "serialize": 0.0}
+    parts = [[] for _ in formats]
+    for chunks in iter_rendered(rows, columns, exporters, counters, products, timings, messages.append if debug else None):
+        for part, chunk in zip(parts, chunks):
+            part.append(chunk)
+    return ["".join(part) for part in parts], products, counters, timings, messages
+
+
+def feed_filename(supplier_id, feed_format):
+    """ Ім'я файлу фіду постачальника у вказаному форматі """
+    return f"{supplier_id}{EXPORTERS[feed_format].suffix}"
+
+
+def build_feeds(supplier_id, supplier_name, rows, columns, directory, formats=DEFAULT_FORMATS, log=None, pool=None, chunks_in_flight=2):
+    """
+    Потоково будує та зберігає фіди постачальника в усіх форматах formats з уже завантажених рядків
+    (CPU-частина генерації). Рядки нормалізуються один раз, і кожен товар одразу серіалізується
+    всіма експортерами — кількість форматів не множить завантаження чи розбір.
+    З pool rows — це послідовність частин рядків: частини обробляються паралельно в пулі процесів
+    (render_chunk), а фрагменти дописуються у фід строго в початковому порядку. У пулі одночасно
+    не більше chunks_in_flight частин, тож пам'ять не росте з розміром постачальника.
+    Фіди записуються в directory; реєструє їх (ETag, каталог файлів, стан) викликач у головному процесі.
+    Повертає знімок товарів {product_id: товар} для розрахунку дельти, лічильники,
+    тривалість етапів {"normalize", "serialize", "write"} і хеші записаних фідів {шлях: etag}.
+    """
+    exporters = [EXPORTERS[feed_format]() for feed_format in formats]
+    target_paths = [os.path.join(directory, feed_filename(supplier_id, feed_format)) for feed_format in formats]
+    counters = {"processed": 0, "skipped": 0}
+    products = {}
+    timings = {"normalize": 0.0, "serialize": 0.0}
+    waited = 0.0  # Скільки головний процес чекав на частини з пулу
+    clock = time.perf_counter
+
+    def chunk_groups():
+        nonlocal waited
+        yield tuple(exporter.header(supplier_id, supplier_name) for exporter in exporters)
+        if pool is None:
+            yield from iter_rendered(rows, columns, exporters, counters, products, timings, log)
+        else:
+            # Черга майбутніх результатів у порядку частин: нову частину віддаємо в пул, лише забравши найстаршу
+            chunks = iter(rows)
+            pending = collections.deque()
+            try:
+                for chunk in itertools.islice(chunks, chunks_in_flight):
+                    pending.append(pool.submit(render_chunk, chunk, columns, formats, log is not None))
+                while pending:
+                    started_at = clock()
+                    fragments, chunk_products, chunk_counters, chunk_timings, messages = pending.popleft().result()
+                    waited += clock() - started_at
+                    chunk = next(chunks, None)
+                    if chunk is not None:
+                        pending.append(pool.submit(render_chunk, chunk, columns, formats, log is not None))
+                    products.update(chunk_products)
+                    for key, amount in chunk_counters.items():
+                        counters[key] += amount
+                    for key, seconds in chunk_timings.items():
+                        timings[key] += seconds  # Сумарний час усіх процесів
+                    for message in messages:
+                        log(message)
+                    yield tuple(fragments)
+            finally:
+                for future in pending:
+                    future.cancel()  # Запис фіду перервався — решту частин не обробляємо
+        yield tuple(exporter.footer() for exporter in exporters)
+
+    started_at = clock()
+    etags = write_feeds(target_paths, chunk_groups())
+    # Етапи йдуть потоково впереміш, тож запис — це все, що лишилося поза нормалізацією та серіалізацією
+    # (для паралельної побудови — поза очікуванням частин з пулу)
+    elapsed = clock() - started_at
+    timings["write"] = elapsed - waited if pool is not None else elapsed - timings["normalize"] - timings["serialize"]
+    return products, counters, timings, etags
+
+
+def build_feeds_isolated(*args, debug=False, **kwargs):
+    """ build_feeds в окремому процесі: DEBUG-записи повертаються разом із результатом, а не пишуться в лог """
+    messages = []
+    return build_feeds(*args, log=messages.append if debug else None, **kwargs), messages
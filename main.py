@@ -1,373 +1,2027 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.templating import Jinja2Templates
 import os
 import threading
-import gspread
-import xml.etree.ElementTree as ET
+import httpx
+from gspread.utils import absolute_range_name, fill_gaps, numericise_all, to_records
+from xml.sax.saxutils import escape as xml_escape
+import itertools
 import json
 import time
 import requests
 import asyncio
 import re
-from datetime import datetime
+from datetime import datetime, timezone
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request as GoogleRequest
 import random
+import heapq
+import contextlib
+import cProfile
+import pstats
+import uuid
 import hashlib
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+import sqlite3
+import zlib
 import urllib.parse
+import collections
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from feed_builder import (
+    COMPRESSED_EXTENSIONS, DEFAULT_FORMATS, EXPORTERS, XmlExporter,
+    build_feeds, build_feeds_isolated, compile_columns, compressed_path, create_temp_file, feed_filename, render_product_xml, write_feeds,
+)
 
 # 🔹 Конфігурація
 MASTER_SHEET_ID = "1z16Xcj_58R2Z-JGOMuyx4GpVdQqDn1UtQirCxOrE_hc"
-XML_DIR = "/output"
-LOG_DIR = "/logs"
-DEBUG_LOG_FILE = os.path.join(LOG_DIR, "debug_log.html")  # Файл, а не директорія!
-UPDATE_INTERVAL = 1800  # 30 хвилин
+XML_DIR = os.getenv("XML_DIR", "/output")
+LOG_DIR = os.getenv("LOG_DIR", "/logs")
+STATE_DIR = os.getenv("STATE_DIR", "/state")  # Постійний стан (хеші, знімки таблиць) — не віддається через HTTP
+STATE_DB = os.path.join(STATE_DIR, "state.sqlite")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # DEBUG — рядок у лозі на кожен товар
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_BATCH_SIZE = 500  # Скільки записів накопичувати перед записом у файл
+LOG_FLUSH_INTERVAL = 1.0  # Як часто фоновий потік скидає буфери логів (сек.)
+DELTA_HISTORY = 48  # Скільки останніх дельт зберігати на постачальника (~доба при оновленні кожні 30 хв)
+DEBUG_LOG_FILE = os.path.join(LOG_DIR, "debug_log.jsonl")  # Файл, а не директорія!
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "7"))  # Логи, старші за стільки днів, видаляються
+LOG_RETENTION_BYTES = int(os.getenv("LOG_RETENTION_MB", "1024")) * 1024 * 1024  # Ліміт загального розміру логів
+CATALOG_RESCAN_INTERVAL = 600  # Як часто звіряти каталоги файлів з диском (файли, додані вручну)
+UPDATE_INTERVAL = 1800  # 30 хвилин — початковий інтервал перевірки постачальника
+MIN_UPDATE_INTERVAL = int(os.getenv("MIN_UPDATE_INTERVAL", "300"))  # Найчастіше — раз на 5 хвилин
+MAX_UPDATE_INTERVAL = int(os.getenv("MAX_UPDATE_INTERVAL", "21600"))  # Найрідше — раз на 6 годин
+INTERVAL_SHRINK = 0.5  # Дані змінилися — перевіряємо вдвічі частіше
+INTERVAL_GROWTH = 1.5  # Дані не змінилися — перевіряємо рідше
+SCHEDULE_JITTER = 0.1  # ±10% до інтервалу, щоб перевірки не збивалися в пачки
+SUPPLIER_LIST_TTL = 300  # Як часто перечитувати список постачальників з головної таблиці (сек.)
+PROFILE_DIR = os.getenv("PROFILE_DIR")  # Якщо задано — cProfile-дамп кожного циклу оновлення в цю папку
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # Межі гістограм (сек.)
+FORMATS_COLUMN = "Formats"  # Формати фідів у "Sheet1" через кому: xml, csv, jsonl
+STOCK_FALSE_VALUES = {"false", "0", "ні", "немає", "нема", "no", "out of stock"}  # Текстові значення "немає в наявності"
+JOB_HISTORY = 100  # Скільки завершених завдань пам'ятати для API статусу
+PRIORITY_COLUMN = "Priority"  # Ручний пріоритет у "Sheet1": high / low / хвилини між перевірками
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))  # Кількість паралельних постачальників (пул потоків для I/O)
+XML_PROCESS_WORKERS = int(os.getenv("XML_PROCESS_WORKERS", "0"))  # >0 — будувати XML у пулі процесів
+PARALLEL_BUILD_THRESHOLD = int(os.getenv("PARALLEL_BUILD_THRESHOLD", "100000"))  # З якої кількості рядків будувати фід частинами паралельно
+PARALLEL_BUILD_WORKERS = int(os.getenv("PARALLEL_BUILD_WORKERS", str(os.cpu_count() or 1)))  # Процесів для паралельної побудови
+PARALLEL_CHUNK_ROWS = 25000  # Рядків в одній частині (частини не перетинають межі аркушів)
+PARALLEL_CHUNKS_IN_FLIGHT = PARALLEL_BUILD_WORKERS * 2  # Скільки частин одночасно в пулі (обмежує пам'ять на буферизовані результати)
+SHEETS_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))  # Квота Sheets API на читання
+SHEETS_MAX_ATTEMPTS = 5  # Скільки разів пробуємо один запит до Sheets API
+RETRY_BASE_DELAY = 2  # Базова пауза експоненційного backoff (сек.)
+MAX_RETRY_TIME = int(os.getenv("MAX_RETRY_TIME", "120"))  # Максимальна пауза між повторами (сек.)
+CIRCUIT_FAILURE_THRESHOLD = 5  # Після стількох помилок поспіль таблиця тимчасово вимикається
+CIRCUIT_COOLDOWN = int(os.getenv("CIRCUIT_COOLDOWN", "600"))  # На скільки секунд вимикається таблиця
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+SHEETS_HTTP_CONNECTIONS = int(os.getenv("SHEETS_HTTP_CONNECTIONS", "20"))  # Пул keep-alive з'єднань до Google API
+SHEETS_HTTP_TIMEOUT = 60  # Тайм-аут одного HTTP-запиту до Google API (сек.)
+SHEETS_METADATA_TTL = int(os.getenv("SHEETS_METADATA_TTL", "900"))  # Скільки тримати список аркушів таблиці в кеші (сек.)
 price_hash_cache = {}
-
-def cleanup_old_logs():
-    """ Видаляє всі логи, які старші за 7 днів """
-    now = time.time()
-    for log_file in os.listdir(LOG_DIR):
-        file_path = os.path.join(LOG_DIR, log_file)
-        if os.path.isfile(file_path) and file_path.startswith("log_") and file_path.endswith(".html"):
-            if os.stat(file_path).st_mtime < now - 7 * 86400:
-                os.remove(file_path)
-                print(f"🗑 Видалено старий лог: {log_file}")
+modified_time_cache = {}  # modifiedTime таблиць з Drive API (дешева перевірка змін)
+config_hash_cache = {}  # Відбиток налаштувань постачальника з "Sheet1", з якими згенеровано фіди
+drive_metadata_available = True
 
 
 # 🔹 Створення директорій
-for dir_path in [XML_DIR, os.path.dirname(DEBUG_LOG_FILE)]:
+for dir_path in [XML_DIR, os.path.dirname(DEBUG_LOG_FILE), STATE_DIR]:
     os.makedirs(dir_path, exist_ok=True)
 
 
+# 🔹 Каталог файлів у пам'яті (списки /output і /logs без os.listdir на кожен запит)
+class FileCatalog:
+    """
+    Метадані файлів однієї папки в пам'яті: name, size, mtime (+ products і etag для фідів).
+    Папка читається повністю лише при першому зверненні та під час планового rescan();
+    далі каталог оновлюють генератор фідів, логер і очищення логів.
+    Відсортовані представлення кешуються до наступної зміни, тож сторінка списку — це зріз O(page).
+    """
+    def __init__(self, directory, include):
+        self.directory = directory
+        self.include = include  # Фільтр імен файлів, які входять до каталогу
+        self.entries = {}
+        self.views = {}  # (sort, reverse, suffix) -> відсортований список записів
+        self.loaded = False
+        self.scanned_at = 0.0
+        self.lock = threading.Lock()
+
+    def rescan(self):
+        """ Повне перечитування папки (файли, додані поза сервісом, з'являються після нього) """
+        entries = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not self.include(name):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            previous = self.entries.get(name, {})
+            entries[name] = {"name": name, "size": stat.st_size, "mtime": stat.st_mtime, "products": previous.get("products"), "etag": previous.get("etag")}
+        with self.lock:
+            self.entries = entries
+            self.views = {}
+            self.loaded = True
+            self.scanned_at = time.time()
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.rescan()
+
+    def update(self, path, **extra):
+        """ Оновлює запис файлу після запису (extra — products, etag) """
+        name = os.path.basename(path)
+        if not self.include(name):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self.remove(path)
+        with self.lock:
+            entry = self.entries.setdefault(name, {"name": name, "products": None, "etag": None})
+            entry.update(size=stat.st_size, mtime=stat.st_mtime, **extra)
+            self.views = {}
+
+    def remove(self, path):
+        with self.lock:
+            if self.entries.pop(os.path.basename(path), None) is not None:
+                self.views = {}
+
+    def items(self):
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.entries.values())
+
+    def page(self, sort="name", reverse=False, page=1, per_page=50, name_filter=None):
+        """
+        Повертає (загальна кількість, [записи сторінки]); name_filter(name) відбирає файли за іменем.
+        per_page=None — усі записи без розбиття на сторінки.
+        """
+        self.ensure_loaded()
+        key = (sort, reverse, name_filter)
+        with self.lock:
+            view = self.views.get(key)
+            if view is None:
+                entries = [entry for entry in self.entries.values() if not name_filter or name_filter(entry["name"])]
+                view = self.views[key] = sorted(entries, key=lambda entry: (entry[sort] is None, entry[sort] or 0, entry["name"]) if sort != "name" else entry["name"], reverse=reverse)
+        if per_page is None:
+            return len(view), [dict(entry) for entry in view]
+        start = (page - 1) * per_page
+        return len(view), [dict(entry) for entry in view[start:start + per_page]]
+
+
+output_catalog = FileCatalog(XML_DIR, lambda name: not name.startswith("."))  # Тимчасові файли та стиснуті копії приховані
+log_catalog = FileCatalog(LOG_DIR, lambda name: name.startswith("log_") and name.endswith((".jsonl", ".html")))
+
+def cleanup_old_logs():
+    """
+    Очищення логів за каталогом (без сканування папки): спершу видаляються логи, старші за
+    LOG_RETENTION_DAYS днів, потім найстаріші — доки загальний розмір не менший за LOG_RETENTION_BYTES.
+    Логи поточних запусків і .idx-індекси до видалених логів теж враховуються.
+    """
+    now = time.time()
+    with run_loggers_lock:
+        active = {os.path.basename(log_filename) for log_filename in run_loggers}
+    logs = sorted((entry for entry in log_catalog.items() if entry["name"] not in active), key=lambda entry: entry["mtime"])
+    total_size = sum(entry["size"] for entry in log_catalog.items())
+
+    for entry in logs:
+        expired = entry["mtime"] < now - LOG_RETENTION_DAYS * 86400
+        if not expired and total_size <= LOG_RETENTION_BYTES:
+            break  # Решта новіші, а ліміт розміру вже дотримано
+        file_path = os.path.join(LOG_DIR, entry["name"])
+        for path in (file_path, os.path.join(LOG_DIR, f".{entry['name']}.idx")):
+            if os.path.exists(path):
+                os.remove(path)
+        log_catalog.remove(file_path)
+        total_size -= entry["size"]
+        print(f"🗑 Видалено старий лог: {entry['name']} ({'за віком' if expired else 'за розміром'})")
+
+
+# 🔹 Рядки зведеного каталогу товарів
+def is_in_stock(stock):
+    """ Чи є товар у наявності (для каталогу потрібне так/ні, а не кількість) """
+    value = stock.strip().lower()
+    if value.isdigit():
+        return int(value) > 0
+    return value not in STOCK_FALSE_VALUES
+
+
+
+
+def catalog_row(supplier_id, supplier_name, product):
+    """ Рядок таблиці catalog для товару постачальника (заглушка "-" замість SKU зберігається як NULL) """
+    sku = product["sku"] if product["sku"] not in ("", "-") else None
+    return (
+        supplier_id, product["id"], supplier_name, sku, product["name"], int(product["price"]),
+        product["currency"], product["stock"], product["rrp"], int(is_in_stock(product["stock"]))
+    )
+
+
+# 🔹 Постійне сховище стану постачальників
+class StateStore:
+    """
+    SQLite-сховище стану постачальників, яке переживає перезапуск контейнера:
+    - content_hash і modified_time — для визначення змін
+    - config_hash — відбиток налаштувань постачальника (колонки, формати), з якими згенеровано фіди
+    - fetched_at і xml_path — коли та куди згенеровано XML
+    - feed_files — хеші вмісту згенерованих фідів для ETag
+    - supplier_products / supplier_deltas — знімок товарів за ID та історія дельт між версіями
+    - supplier_schedule — адаптивний інтервал перевірки та час наступної перевірки
+    - catalog (+ повнотекстовий catalog_fts) — зведений каталог товарів усіх постачальників
+      з індексами за ID товару, SKU та постачальником; оновлюється разом зі знімком товарів
+    Кожен запис оновлюється в окремій транзакції, тож стан завжди узгоджений.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS supplier_state (
+                    supplier_id TEXT PRIMARY KEY,
+                    content_hash TEXT,
+                    modified_time TEXT,
+                    config_hash TEXT,
+                    fetched_at REAL,
+                    xml_path TEXT
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS supplier_products (
+                    supplier_id TEXT PRIMARY KEY,
+                    version INTEGER,
+                    products BLOB
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS feed_files (
+                    filename TEXT PRIMARY KEY,
+                    etag TEXT,
+                    mtime_ns INTEGER,
+                    size INTEGER
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS supplier_deltas (
+                    supplier_id TEXT,
+                    version INTEGER,
+                    created_at REAL,
+                    payload BLOB,
+                    PRIMARY KEY (supplier_id, version)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS supplier_schedule (
+                    supplier_id TEXT PRIMARY KEY,
+                    interval REAL,
+                    next_run REAL,
+                    checks INTEGER,
+                    changes INTEGER
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS catalog (
+                    supplier_id TEXT,
+                    product_id TEXT,
+                    supplier_name TEXT,
+                    sku TEXT,
+                    name TEXT,
+                    price INTEGER,
+                    currency TEXT,
+                    stock TEXT,
+                    rrp TEXT,
+                    in_stock INTEGER,
+                    PRIMARY KEY (supplier_id, product_id)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS catalog_sku ON catalog (sku, price)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS catalog_product ON catalog (product_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS catalog_supplier_price ON catalog (supplier_id, price)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS catalog_price ON catalog (price)")
+        self.full_text = self.create_full_text_index()
+        self.backfill_catalog()
+
+    def create_full_text_index(self):
+        """
+        Повнотекстовий індекс FTS5 за назвою, SKU та ID (синхронізується тригерами).
+        Повертає False, якщо SQLite зібрано без FTS5 — тоді пошук іде через LIKE.
+        """
+        try:
+            with self.conn:
+                self.conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+                        name, sku, product_id, content='catalog', tokenize='unicode61 remove_diacritics 2'
+                    )
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS catalog_ai AFTER INSERT ON catalog BEGIN
+                        INSERT INTO catalog_fts (rowid, name, sku, product_id) VALUES (new.rowid, new.name, new.sku, new.product_id);
+                    END
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS catalog_ad AFTER DELETE ON catalog BEGIN
+                        INSERT INTO catalog_fts (catalog_fts, rowid, name, sku, product_id) VALUES ('delete', old.rowid, old.name, old.sku, old.product_id);
+                    END
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS catalog_au AFTER UPDATE ON catalog BEGIN
+                        INSERT INTO catalog_fts (catalog_fts, rowid, name, sku, product_id) VALUES ('delete', old.rowid, old.name, old.sku, old.product_id);
+                        INSERT INTO catalog_fts (rowid, name, sku, product_id) VALUES (new.rowid, new.name, new.sku, new.product_id);
+                    END
+                """)
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def backfill_catalog(self):
+        """ Одноразово заповнює порожній каталог зі збережених знімків товарів (після оновлення сервісу) """
+        with self.lock, self.conn:
+            if self.conn.execute("SELECT 1 FROM catalog LIMIT 1").fetchone():
+                return
+            for supplier_id, blob in self.conn.execute("SELECT supplier_id, products FROM supplier_products").fetchall():
+                products = json.loads(zlib.decompress(blob).decode("utf-8"))
+                self.upsert_catalog(supplier_id, None, products.values())
+
+    def upsert_catalog(self, supplier_id, supplier_name, products):
+        """ Додає або оновлює товари в каталозі (викликається всередині транзакції) """
+        self.conn.executemany("""
+            INSERT INTO catalog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (supplier_id, product_id) DO UPDATE SET
+                supplier_name = COALESCE(excluded.supplier_name, supplier_name), sku = excluded.sku, name = excluded.name,
+                price = excluded.price, currency = excluded.currency, stock = excluded.stock, rrp = excluded.rrp,
+                in_stock = excluded.in_stock
+        """, (catalog_row(supplier_id, supplier_name, product) for product in products))
+
+    def load(self):
+        """ Повертає {supplier_id: (content_hash, modified_time, config_hash, xml_path)} для всіх постачальників """
+        with self.lock:
+            rows = self.conn.execute("SELECT supplier_id, content_hash, modified_time, config_hash, xml_path FROM supplier_state").fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def save(self, supplier_id, content_hash, modified_time, config_hash, xml_path):
+        """ Атомарно зберігає новий хеш, відбиток налаштувань і шлях до XML постачальника """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO supplier_state VALUES (?, ?, ?, ?, ?, ?)",
+                (supplier_id, content_hash, modified_time, config_hash, time.time(), xml_path)
+            )
+
+    def touch(self, supplier_id, modified_time):
+        """ Оновлює modifiedTime і час перевірки, коли дані не змінилися """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE supplier_state SET modified_time = ?, fetched_at = ? WHERE supplier_id = ?",
+                (modified_time, time.time(), supplier_id)
+            )
+
+    def get_products(self, supplier_id):
+        """ Повертає (версія, {product_id: товар}) з останньої генерації або (0, None) """
+        with self.lock:
+            row = self.conn.execute("SELECT version, products FROM supplier_products WHERE supplier_id = ?", (supplier_id,)).fetchone()
+        if not row:
+            return 0, None
+        return row[0], json.loads(zlib.decompress(row[1]).decode("utf-8"))
+
+    def save_products(self, supplier_id, version, products, delta=None, supplier_name=None):
+        """
+        Атомарно зберігає новий знімок товарів, (якщо є) дельту до нього та зміни в каталозі:
+        без дельти каталог постачальника замінюється повністю, з дельтою — лише змінені рядки.
+        Зберігається не більше DELTA_HISTORY останніх дельт на постачальника.
+        """
+        blob = zlib.compress(json.dumps(products, ensure_ascii=False).encode("utf-8"))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO supplier_products VALUES (?, ?, ?)", (supplier_id, version, blob))
+            if delta is None:
+                self.conn.execute("DELETE FROM catalog WHERE supplier_id = ?", (supplier_id,))
+                self.upsert_catalog(supplier_id, supplier_name, products.values())
+            else:
+                self.conn.executemany("DELETE FROM catalog WHERE supplier_id = ? AND product_id = ?", [(supplier_id, product_id) for product_id in delta["deleted"]])
+                self.upsert_catalog(supplier_id, supplier_name, itertools.chain(delta["inserted"], delta["updated"]))
+                if supplier_name:  # Перейменування постачальника — лише в його рядках каталогу
+                    self.conn.execute("UPDATE catalog SET supplier_name = ? WHERE supplier_id = ? AND supplier_name IS NOT ?", (supplier_name, supplier_id, supplier_name))
+            if delta is not None:
+                payload = zlib.compress(json.dumps(delta, ensure_ascii=False).encode("utf-8"))
+                self.conn.execute("INSERT OR REPLACE INTO supplier_deltas VALUES (?, ?, ?, ?)", (supplier_id, version, time.time(), payload))
+                self.conn.execute(
+                    "DELETE FROM supplier_deltas WHERE supplier_id = ? AND version <= ?",
+                    (supplier_id, version - DELTA_HISTORY)
+                )
+
+    def get_deltas(self, supplier_id, since):
+        """ Повертає (поточна версія, найстаріша збережена версія дельти, [дельти з версією > since]) """
+        with self.lock:
+            current = self.conn.execute("SELECT version FROM supplier_products WHERE supplier_id = ?", (supplier_id,)).fetchone()
+            oldest = self.conn.execute("SELECT MIN(version) FROM supplier_deltas WHERE supplier_id = ?", (supplier_id,)).fetchone()
+            rows = self.conn.execute(
+                "SELECT payload FROM supplier_deltas WHERE supplier_id = ? AND version > ? ORDER BY version",
+                (supplier_id, since)
+            ).fetchall()
+        deltas = [json.loads(zlib.decompress(row[0]).decode("utf-8")) for row in rows]
+        return (current[0] if current else 0), oldest[0], deltas
+
+    def get_feed(self, filename):
+        """ Повертає збережені метадані фіду {"etag", "mtime_ns", "size"} або None """
+        with self.lock:
+            row = self.conn.execute("SELECT etag, mtime_ns, size FROM feed_files WHERE filename = ?", (filename,)).fetchone()
+        return {"etag": row[0], "mtime_ns": row[1], "size": row[2]} if row else None
+
+    def save_feed(self, filename, etag, mtime_ns, size):
+        """ Зберігає хеш вмісту фіду для ETag """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO feed_files VALUES (?, ?, ?, ?)", (filename, etag, mtime_ns, size))
+
+    def delete_feed(self, filename):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM feed_files WHERE filename = ?", (filename,))
+
+    def load_schedule(self):
+        """ Повертає {supplier_id: {"interval", "next_run", "checks", "changes"}} """
+        with self.lock:
+            rows = self.conn.execute("SELECT supplier_id, interval, next_run, checks, changes FROM supplier_schedule").fetchall()
+        return {row[0]: {"interval": row[1], "next_run": row[2], "checks": row[3], "changes": row[4]} for row in rows}
+
+    def save_schedules(self, rows):
+        """ Зберігає розклад кількох постачальників однією транзакцією: [(supplier_id, interval, next_run, checks, changes)] """
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO supplier_schedule VALUES (?, ?, ?, ?, ?)", rows)
+
+    def find_offers(self, code, currency=None, in_stock=None):
+        """ Пропозиції всіх постачальників за SKU або ID товару, від найдешевшої """
+        query = "SELECT * FROM catalog WHERE (sku = ? OR product_id = ?)"
+        params = [code, code]
+        if currency:
+            query += " AND currency = ?"
+            params.append(currency)
+        if in_stock is not None:
+            query += " AND in_stock = ?"
+            params.append(int(in_stock))
+        with self.lock:
+            cursor = self.conn.execute(query + " ORDER BY price", params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def search_catalog(self, text=None, supplier_id=None, currency=None, in_stock=None, sort="price", page=1, per_page=50):
+        """ Посторінковий пошук у каталозі; повертає (загальна кількість, [товари сторінки]) """
+        conditions, params = [], []
+        tokens = re.findall(r"\w+", text or "")
+        if tokens and self.full_text:
+            # Кожне слово — префіксний пошук, усі слова мають збігтися
+            conditions.append("rowid IN (SELECT rowid FROM catalog_fts WHERE catalog_fts MATCH ?)")
+            params.append(" ".join(f'"{token}"*' for token in tokens))
+        for token in (tokens if not self.full_text else []):
+            conditions.append("(name LIKE ? OR sku LIKE ? OR product_id LIKE ?)")
+            params.extend([f"%{token}%"] * 3)
+        for column, value in (("supplier_id", supplier_id), ("currency", currency)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if in_stock is not None:
+            conditions.append("in_stock = ?")
+            params.append(int(in_stock))
+
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = {"price": "price, supplier_id, product_id", "-price": "price DESC, supplier_id, product_id", "name": "name, supplier_id, product_id"}[sort]
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) FROM catalog{where}", params).fetchone()[0]
+            cursor = self.conn.execute(f"SELECT * FROM catalog{where} ORDER BY {order} LIMIT ? OFFSET ?", params + [per_page, (page - 1) * per_page])
+            columns = [column[0] for column in cursor.description]
+            return total, [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def evict(self, active_ids):
+        """ Видаляє постачальників, яких більше немає в головній таблиці; повертає їхні ID """
+        with self.lock, self.conn:
+            stored_ids = {row[0] for row in self.conn.execute("SELECT supplier_id FROM supplier_state")}
+            stored_ids |= {row[0] for row in self.conn.execute("SELECT supplier_id FROM supplier_products")}
+            stored_ids |= {row[0] for row in self.conn.execute("SELECT supplier_id FROM supplier_schedule")}
+            removed = stored_ids - set(active_ids)
+            for table in ("supplier_state", "supplier_products", "supplier_deltas", "supplier_schedule", "catalog"):
+                self.conn.executemany(f"DELETE FROM {table} WHERE supplier_id = ?", [(supplier_id,) for supplier_id in removed])
+        return removed
+
+
+state_store = StateStore(STATE_DB)
+
+# 🔹 Відновлюємо кеш хешів після перезапуску (лише для постачальників, чий XML ще існує)
+for supplier_id, (content_hash, modified_time, config_hash, xml_path) in state_store.load().items():
+    if xml_path and os.path.exists(xml_path):
+        price_hash_cache[supplier_id] = content_hash
+        modified_time_cache[supplier_id] = modified_time
+        config_hash_cache[supplier_id] = config_hash
+
+
 
 
 def get_log_filename():
     """ Генерує унікальне ім'я лог-файлу на основі часу запуску """
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    return os.path.join(LOG_DIR, f"log_{timestamp}.html")
+    return os.path.join(LOG_DIR, f"log_{timestamp}.jsonl")
 
-def log_to_file(content, log_filename):
-    """ Записує лог у файл із HTML-форматуванням """
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# 🔹 Буферизований логер циклу
+class RunLogger:
+    """
+    Лог одного запуску (циклу) з буфером у пам'яті:
+    - кожен запис — окремий JSON-рядок (ts, level, supplier, event, message, counts);
+      HTML будується лише при перегляді
+    - записи накопичуються в буфері й дописуються у файл пачками (LOG_BATCH_SIZE)
+      або фоновим потоком раз на LOG_FLUSH_INTERVAL секунд
+    - записи нижче LOG_LEVEL відкидаються одразу
+    - counters — підсумкові лічильники по постачальниках замість рядка на кожен товар
+    """
+    def __init__(self, log_filename):
+        self.log_filename = log_filename
+        self.buffer = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.last_write = time.monotonic()
+
+    def log(self, content, level, supplier=None, event=None, counts=None):
+        record = {
+            "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "level": level,
+            "supplier": supplier,
+            "event": event,
+            "message": content,
+        }
+        if counts:
+            record["counts"] = counts
+        entry = json.dumps(record, ensure_ascii=False) + "\n"
+
+        with self.lock:
+            self.buffer.append(entry)
+            self.last_write = time.monotonic()
+            should_flush = len(self.buffer) >= LOG_BATCH_SIZE
+        if should_flush:
+            self.flush()
+
+    def count(self, supplier, **amounts):
+        """ Додає значення до підсумкових лічильників постачальника (processed=..., skipped=...) """
+        with self.lock:
+            supplier_counters = self.counters.setdefault(supplier, {})
+            for counter, amount in amounts.items():
+                supplier_counters[counter] = supplier_counters.get(counter, 0) + amount
+
+    def flush(self):
+        """ Дописує накопичені записи у файл одним викликом write """
+        with self.lock:
+            if not self.buffer:
+                return
+            with open(self.log_filename, "a", encoding="utf-8") as f:
+                f.write("".join(self.buffer))
+            self.buffer = []
+        log_catalog.update(self.log_filename)
 
-    # 🔹 Автоматичне форматування за ключовими словами
-    if "✅" in content:
-        content = f'<span style="color:green;">{content}</span>'
-    elif "⚠️" in content:
-        content = f'<span style="color:orange;">{content}</span>'
-    elif "❌" in content:
-        content = f'<span style="color:red;">{content}</span>'
-    elif "🔄" in content:
-        content = f'<span style="color:blue;">{content}</span>'
+    def write_summary(self):
+        """ Записує підсумок по постачальниках (один рядок на постачальника) """
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for supplier, supplier_counters in counters:
+            details = ", ".join(f"{LOG_COUNTER_LABELS.get(counter, counter)}: {amount}" for counter, amount in sorted(supplier_counters.items()))
+            self.log(f"📊 {supplier}: {details}", "INFO", supplier=supplier, event="summary", counts=supplier_counters)
 
-    log_entry = f"[{timestamp}] {content}<br>\n"
 
-    with open(log_filename, "a", encoding="utf-8") as f:
-        f.write(log_entry)
+def detect_log_level(content):
+    """ Визначає рівень за емодзі-маркером повідомлення """
+    if "❌" in content:
+        return "ERROR"
+    if "⚠️" in content:
+        return "WARNING"
+    return "INFO"
 
-# 🔹 Авторизація Google Sheets
-GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
-TOKEN_JSON = os.getenv("TOKEN_JSON")
-if not GOOGLE_CREDENTIALS or not TOKEN_JSON:
-    raise ValueError("❌ GOOGLE_CREDENTIALS або TOKEN_JSON відсутні!")
 
-TOKEN_FILE = json.loads(TOKEN_JSON)
-CREDENTIALS_FILE = json.loads(GOOGLE_CREDENTIALS)
+def log_enabled(level):
+    """ Чи буде записано повідомлення цього рівня (щоб не форматувати зайві рядки) """
+    return LOG_LEVELS[level] >= LOG_LEVELS.get(LOG_LEVEL, LOG_LEVELS["INFO"])
+
+
+LOG_COUNTER_LABELS = {"processed": "додано товарів", "skipped": "пропущено"}
+
+run_loggers = {}
+run_loggers_lock = threading.Lock()
+
+
+def get_run_logger(log_filename=None):
+    """ Повертає (або створює) буферизований логер для файлу """
+    log_filename = log_filename or DEBUG_LOG_FILE
+    with run_loggers_lock:
+        logger = run_loggers.get(log_filename)
+        if logger is None:
+            logger = run_loggers[log_filename] = RunLogger(log_filename)
+        return logger
 
-def get_google_client():
-    """ Функція авторизації в Google Sheets з обробкою помилки 429 """
-    log_filename = get_log_filename()
-    retry_count = 0
-    max_retries = 5  # Спроба до 5 разів при помилці 429
 
-    while retry_count < max_retries:
+def close_run_logger(log_filename):
+    """ Записує підсумок, скидає буфер на диск і прибирає логер із реєстру """
+    with run_loggers_lock:
+        logger = run_loggers.pop(log_filename, None)
+    if logger:
+        logger.write_summary()
+        logger.flush()
+
+
+def flush_logs():
+    """ Скидає буфери всіх логерів; неактивні понад 10 хвилин логери прибирає """
+    with run_loggers_lock:
+        loggers = list(run_loggers.items())
+    for log_filename, logger in loggers:
+        logger.flush()
+        if time.monotonic() - logger.last_write > 600:
+            with run_loggers_lock:
+                run_loggers.pop(log_filename, None)
+
+
+def log_flusher():
+    """ Фоновий потік, що періодично скидає буфери логів на диск """
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
         try:
-            creds = Credentials.from_authorized_user_info(TOKEN_FILE)
+            flush_logs()
+        except Exception as e:
+            print(f"⚠️ Помилка запису логів: {e}")
 
-            if not creds or not creds.valid:
-                if creds.expired and creds.refresh_token:
-                    creds.refresh(GoogleRequest(requests.Session()))
-                    log_to_file("🔄 Токен оновлено", log_filename)
-                else:
-                    flow = InstalledAppFlow.from_client_config(
-                        CREDENTIALS_FILE, ["https://www.googleapis.com/auth/spreadsheets"]
-                    )
-                    creds = flow.run_local_server(port=8080)
 
-            return gspread.authorize(creds)  # Якщо успішно — виходимо з циклу
+threading.Thread(target=log_flusher, name="log-flusher", daemon=True).start()
 
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):  # Обробка перевищення ліміту API
-                retry_count += 1
-                wait_time = retry_count * 20  # Динамічне збільшення часу очікування
-                log_to_file(f"⚠️ Перевищено ліміт API Google Sheets. Повторна спроба {retry_count}/{max_retries} через {wait_time} сек.", log_filename)
-                time.sleep(wait_time)  # Чекаємо перед повторною спробою
-            else:
-                log_to_file(f"❌ Помилка авторизації Google Sheets: {e}", log_filename)
-                raise e  # Якщо це не 429, завершуємо виконання
 
-    log_to_file("❌ Всі спроби авторизації у Google Sheets провалилися.", log_filename)
-    raise Exception("Не вдалося авторизуватись у Google Sheets після кількох спроб.")
+def log_to_file(content, log_filename=None, level=None, supplier=None, event=None, counts=None):
+    """
+    Додає структурований запис у буферизований лог циклу.
+    Рівень визначається за емодзі, якщо не вказаний явно; без log_filename пише в DEBUG_LOG_FILE.
+    """
+    level = level or detect_log_level(content)
+    if not log_enabled(level):
+        return
+    get_run_logger(log_filename).log(content, level, supplier=supplier, event=event, counts=counts)
 
-client = get_google_client()
-spreadsheet = client.open_by_key(MASTER_SHEET_ID)
+# 🔹 Читання логів: розріджений індекс зміщень і посторінкові запити
+LOG_INDEX_STEP = 1000  # Зміщення запам'ятовується для кожного N-го рядка
 
-# 🔹 Функція безпечного отримання значень
-def safe_get_value(row, column_letter, default_value="-"):
+
+def get_log_index(file_path):
     """
-    Отримує значення комірки, враховуючи колонку у форматі 'A', 'B', 'C'...
-    - Перевіряє, чи є значення в межах рядка
-    - Видаляє зайві пробіли та приховані символи
-    - Завжди повертає рядок
+    Повертає розріджений індекс лог-файлу {"size", "lines", "offsets"}.
+    Індекс зберігається поруч (.{ім'я}.idx) і щоразу дочитується лише з нового хвоста файлу.
     """
-    try:
-        if column_letter and column_letter.isalpha():
-            col_index = ord(column_letter.upper()) - 65  # A -> 0, B -> 1, C -> 2 ...
-            if len(row) > col_index:
-                value = str(row[col_index]).strip()
-                return value if value else default_value
-    except Exception as e:
-        log_to_file(f"⚠️ Помилка при отриманні значення ({column_letter}): {e}")
+    index_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.idx")
+    index = {"size": 0, "lines": 0, "offsets": []}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    size = os.path.getsize(file_path)
+    if size < index["size"]:  # Файл перезаписано — будуємо індекс наново
+        index = {"size": 0, "lines": 0, "offsets": []}
+
+    if size > index["size"]:
+        offset = index["size"]
+        lines = index["lines"]
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Останній рядок ще дописується
+                if lines % LOG_INDEX_STEP == 0:
+                    index["offsets"].append(offset)
+                offset += len(line)
+                lines += 1
+        index["size"] = offset
+        index["lines"] = lines
+        try:
+            write_atomic(index_path, [json.dumps(index)])
+        except OSError as e:  # Індекс — лише кеш: наступний запит дочитає файл знову
+            print(f"⚠️ Не вдалося зберегти індекс логу {index_path}: {e}")
+
+    return index
+
+
+def iter_log_lines(file_path, index, start=0):
+    """ Повертає рядки лог-файлу, починаючи з рядка start (seek за індексом, без читання всього файлу) """
+    if start >= index["lines"]:
+        return
+    block = start // LOG_INDEX_STEP
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        f.seek(index["offsets"][block])
+        for _ in range(start - block * LOG_INDEX_STEP):
+            f.readline()
+        for _ in range(index["lines"] - start):
+            yield f.readline()
+
+
+def parse_log_line(line, structured):
+    """ Розбирає рядок логу: JSONL-запис або рядок старого HTML-логу """
+    if structured:
+        try:
+            return json.loads(line)
+        except ValueError:
+            return {"level": "ERROR", "message": line.strip()}
+    return {"level": None, "html": line.strip()}
+
+
+def log_entry_matches(entry, supplier, level):
+    """ Фільтр записів за постачальником і мінімальним рівнем """
+    if supplier and (entry.get("supplier") or "").lower() != supplier.lower():
+        return False
+    if level and LOG_LEVELS.get(entry.get("level") or "INFO", 0) < LOG_LEVELS.get(level, 0):
+        return False
+    return True
 
-    return default_value
 
-## 🔹 Функція для очищення ціни
-def clean_price(value):
+def query_log(file_path, page=1, per_page=200, tail=None, supplier=None, level=None):
     """
-    Очищає та форматує значення ціни:
-    - Видаляє всі нечислові символи, крім коми та крапки
-    - Якщо є десятковий роздільник, зберігає лише цілу частину
-    - Повертає значення у вигляді рядка
+    Вибирає одну сторінку записів логу. Пам'ять обмежена розміром сторінки:
+    - без фільтрів — прямий seek до потрібного рядка за індексом
+    - з фільтрами — послідовний перегляд із відкиданням рядків до потрібної сторінки
+    - tail=N — останні N записів (з урахуванням фільтрів)
+    Повертає (загальна кількість рядків, записи, чи є наступна сторінка).
     """
-    try:
-        if not value:
-            return "0"
+    index = get_log_index(file_path)
+    structured = file_path.endswith(".jsonl")
+    level = level.upper() if level else None
+    filtered = bool(supplier or level)
+
+    if tail:
+        if not filtered:
+            lines = iter_log_lines(file_path, index, max(0, index["lines"] - tail))
+            return index["lines"], [parse_log_line(line, structured) for line in lines], False
+        entries = collections.deque(maxlen=tail)
+        for line in iter_log_lines(file_path, index):
+            entry = parse_log_line(line, structured)
+            if log_entry_matches(entry, supplier, level):
+                entries.append(entry)
+        return index["lines"], list(entries), False
+
+    skip = (page - 1) * per_page
+    if not filtered:
+        lines = itertools.islice(iter_log_lines(file_path, index, skip), per_page)
+        entries = [parse_log_line(line, structured) for line in lines]
+        return index["lines"], entries, skip + per_page < index["lines"]
+
+    entries = []
+    for line in iter_log_lines(file_path, index):
+        entry = parse_log_line(line, structured)
+        if not log_entry_matches(entry, supplier, level):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        if len(entries) == per_page:
+            return index["lines"], entries, True
+        entries.append(entry)
+    return index["lines"], entries, False
+
+
+def resolve_log_path(filename):
+    """ Перевіряє ім'я лог-файлу (без виходу за межі LOG_DIR) і повертає шлях до нього """
+    safe_filename = urllib.parse.unquote(filename)
+    file_path = os.path.join(LOG_DIR, safe_filename)
 
-        value = re.sub(r"[^\d,\.]", "", value)
+    if os.path.basename(safe_filename) != safe_filename or safe_filename.startswith(".") or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="❌ Файл не знайдено")
+    return safe_filename, file_path
 
-        # Якщо є десятковий роздільник, залишаємо лише цілу частину
-        if "," in value:
-            value = value.split(",")[0]
-        elif "." in value:
-            value = value.split(".")[0]
 
-        return value if value else "0"
+# 🔹 Метрики (формат Prometheus)
+def escape_label_value(value):
+    """ Екранування значення мітки за специфікацією Prometheus: \\, " і перенесення рядка """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-    except Exception as e:
-        log_to_file(f"⚠️ Помилка обробки ціни: {value} - {e}")
-        return "0"
+def format_labels(labels, extra=None):
+    """ Рядок міток {a="1",b="2"} """
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in items) + "}"
 
 
-# 🔹 Функція генерації XML
-# 🔹 Функція для створення XML
+class MetricsRegistry:
+    """
+    Мінімальний потокобезпечний реєстр метрик без зовнішніх залежностей:
+    лічильники (counter), поточні значення (gauge) та гістограми (histogram) з мітками.
+    Значення зберігаються за кортежем відсортованих міток; render() віддає текстовий формат Prometheus.
+    """
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> {"type", "help", "values": {labels: значення}}
+
+    def register(self, name, metric_type, help_text):
+        self.metrics[name] = {"type": metric_type, "help": help_text, "values": {}}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics[name]["values"]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name]["values"][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics[name]["values"]
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ with metrics.timer(...): — записує тривалість блоку в гістограму """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for labels, value in metric["values"].items():
+                    if metric["type"] != "histogram":
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                        continue
+                    for bound, amount in zip(self.buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(labels, ('le', bound))} {amount}")
+                    lines.append(f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} {value['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value['sum']:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.register("xml_stage_seconds", "histogram", "Тривалість етапів генерації (fetch, hash, normalize, serialize, write) по постачальниках")
+metrics.register("xml_rows_total", "counter", "Оброблені (processed) і пропущені (skipped) рядки по постачальниках")
+metrics.register("xml_rows_per_second", "gauge", "Швидкість останньої генерації XML, рядків/с")
+metrics.register("sheets_requests_total", "counter", "Запити до Google Sheets API за кодом відповіді")
+metrics.register("sheets_request_seconds", "histogram", "Тривалість одного запиту до Google Sheets API")
+metrics.register("sheets_retries_total", "counter", "Повторні спроби запитів за кодом відповіді (429 — квота)")
+metrics.register("sheets_metadata_cache_total", "counter", "Звернення до кешу метаданих таблиць (hit — без запиту до API)")
+metrics.register("change_checks_total", "counter", "Перевірки змін: modified_time / hash — пропуск за кешем, changed — дані змінилися, new — перша генерація")
+metrics.register("supplier_refresh_total", "counter", "Результати перевірки постачальників")
+metrics.register("update_cycle_seconds", "histogram", "Тривалість циклу оновлення")
+metrics.register("process_pool_restarts_total", "counter", "Пули процесів побудови, замінені новими після аварійного завершення процесу")
+
+
+def error_code(error):
+    """ Код помилки для міток метрик: HTTP-код APIError або назва класу винятку """
+    return str(getattr(error, "code", None) or type(error).__name__)
+
+
+# 🔹 Обмеження частоти запитів до Google Sheets
+class TokenBucket:
+    """
+    Глобальний обмежувач запитів (token bucket), спільний для всіх запитів до Google:
+    - rate_per_minute — скільки запитів дозволено за хвилину (квота Sheets API)
+    - capacity — максимальний запас токенів для коротких сплесків
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute // 6)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    async def acquire(self, tokens=1):
+        """ Чекає (не блокуючи цикл подій), доки в кошику не з'явиться вільний токен """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    # Під час паузи токени не накопичуються, щоб після неї не було сплеску запитів
+                    self.updated_at = now
+                    wait_time = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait_time = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(wait_time)
+
+    def pause(self, seconds):
+        """ Зупиняє видачу токенів для всіх запитів (Google повернув 429 — квота вичерпана) """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+rate_limiter = TokenBucket(SHEETS_REQUESTS_PER_MINUTE)
+
 
-def create_xml(supplier_id, supplier_name, sheet_id, columns, log_filename):
-    """ Генерація XML-файлу з обробкою помилок API та поля наявності """
-    log_to_file(f"📥 Обробка: {supplier_name} ({sheet_id})", log_filename)
+class CircuitOpenError(Exception):
+    """ Таблиця тимчасово вимкнена запобіжником після серії помилок """
 
-    xml_file = os.path.join(XML_DIR, f"{supplier_id}.xml")
-    retry_count = 0
-    max_retries = 5
 
-    while retry_count < max_retries:
+class SheetsAPIError(Exception):
+    """ Помилка відповіді Google API: code — HTTP-код, response — відповідь httpx (для Retry-After) """
+    def __init__(self, response):
+        self.response = response
+        self.code = response.status_code
         try:
-            spreadsheet = client.open_by_key(sheet_id)
-            sheets = spreadsheet.worksheets()
-            combined_data = []
-
-            for sheet in sheets:
-                data = sheet.get_all_values()
-                if len(data) < 2:
-                    log_to_file(f"⚠️ Аркуш {sheet.title} порожній", log_filename)
-                    continue
-                combined_data.extend(data[1:])  # Пропускаємо заголовки
+            message = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = response.text[:200]
+        super().__init__(f"{self.code}: {message}")
 
-            if not combined_data:
-                log_to_file(f"⚠️ {supplier_name}: Немає даних у таблицях", log_filename)
-                return
 
-            root = ET.Element("products")
-            processed_count = 0
-            skipped_count = 0
-
-            for row in combined_data:
-                product_id = safe_get_value(row, columns.get("ID"))
-                name = safe_get_value(row, columns.get("Name"))
-                raw_price = safe_get_value(row, columns.get("Price"), "0")
-                price = clean_price(raw_price)
-
-                # 🔹 Обробка поля stock (наявність)
-                if columns.get("Stock"):
-                    raw_stock = safe_get_value(row, columns.get("Stock")).strip()
-
-                    if raw_stock in ["", "-"]:
-                        stock = "0"
-                    elif re.match(r"^\d+([.,]\d+)?$", raw_stock):  # Число з комою або крапкою
-                        stock = str(int(float(raw_stock.replace(",", "."))))
-                    else:
-                        stock = raw_stock  # Наприклад: "є", "true"
-                else:
-                    stock = "true"
+SHEETS_ERRORS = (SheetsAPIError, CircuitOpenError, httpx.HTTPError)  # Помилки доступу до таблиці, після яких постачальника пропускаємо
 
-                sku = safe_get_value(row, columns.get("SKU"))
-                rrp = clean_price(safe_get_value(row, columns.get("RRP")))
-                currency = safe_get_value(row, columns.get("Currency"), "UAH")
 
-                # 🔴 Пропуск товарів без ID, Name або з ціною ≤ 0
-                if not product_id or not name or not price or int(price) <= 0:
-                    log_to_file(f"❌ Пропускаємо товар (некоректні дані або ціна = 0): id='{product_id}', name='{name}', price='{price}'", log_filename)
-                    skipped_count += 1
-                    continue
+def get_retry_after(error):
+    """ Повертає паузу із заголовка Retry-After (секунди або HTTP-дата) або None """
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-                log_to_file(f"✅ Додаємо товар: id='{product_id}', name='{name}', price='{price}', stock='{stock}'", log_filename)
+def is_retryable(error):
+    """ 429, 5xx та мережеві збої варто повторити; решта (403, 404, 400) — ні """
+    if isinstance(error, SheetsAPIError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, httpx.TransportError)
 
-                product = ET.SubElement(root, "product")
-                ET.SubElement(product, "id").text = product_id
-                ET.SubElement(product, "name").text = name
-                ET.SubElement(product, "stock").text = stock
-                ET.SubElement(product, "price").text = price
-                ET.SubElement(product, "currency").text = currency
 
-                if sku:
-                    ET.SubElement(product, "sku").text = sku
-                if rrp and rrp != "0":
-                    ET.SubElement(product, "rrp").text = rrp
+class SheetsQuota:
+    """
+    Єдиний шар для всіх запитів до Google Sheets:
+    - спільна хвилинна квота (TokenBucket) для всіх постачальників;
+    - експоненційний backoff із jitter, з урахуванням Retry-After;
+    - на 429 пауза ставиться на всю квоту, а не лише на один запит;
+    - запобіжник (circuit breaker) на кожну таблицю окремо — лише для помилок самої таблиці:
+      429 означає вичерпану спільну квоту, і вимикати через неї таблицю (особливо головну) не можна.
+    """
+    def __init__(self, limiter, max_attempts=SHEETS_MAX_ATTEMPTS):
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.circuits = {}  # sheet_id -> {"failures": n, "open_until": monotonic}
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt, error):
+        """ Пауза перед наступною спробою: Retry-After або full jitter 0..base*2^attempt """
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after + random.uniform(0, 1), MAX_RETRY_TIME)
+        return random.uniform(0, min(RETRY_BASE_DELAY * 2 ** attempt, MAX_RETRY_TIME))
+
+    def check_circuit(self, key):
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit and circuit["open_until"] > time.monotonic():
+                raise CircuitOpenError(f"Таблицю {key} тимчасово вимкнено після {circuit['failures']} помилок поспіль")
+
+    def record_success(self, key):
+        with self.lock:
+            self.circuits.pop(key, None)
+
+    def record_failure(self, key):
+        """ Рахує помилку; після порогу (і після кожної невдалої пробної спроби) вимикає таблицю """
+        with self.lock:
+            circuit = self.circuits.setdefault(key, {"failures": 0, "open_until": 0.0})
+            circuit["failures"] += 1
+            if circuit["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+                circuit["open_until"] = time.monotonic() + CIRCUIT_COOLDOWN
+                return True
+            return False
+
+    async def call(self, key, func, *args, log_filename=None, **kwargs):
+        """
+        Виконує запит await func(*args, **kwargs) до таблиці key через квоту та повтори.
+        Паузи — asyncio.sleep, тож інші запити в тому ж циклі подій тим часом виконуються.
+        Повтори й спрацювання запобіжника пишуться в лог циклу log_filename.
+        """
+        for attempt in range(self.max_attempts):
+            self.check_circuit(key)
+            await self.limiter.acquire()
+            started_at = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                metrics.observe("sheets_request_seconds", time.perf_counter() - started_at)
+                metrics.inc("sheets_requests_total", code=error_code(e))
+                retryable = is_retryable(e)
+                quota_exceeded = getattr(e, "code", None) == 429
+                if not quota_exceeded and self.record_failure(key):
+                    log_to_file(f"🔌 Таблицю {key} вимкнено на {CIRCUIT_COOLDOWN} сек. після {CIRCUIT_FAILURE_THRESHOLD} помилок поспіль: {e}", log_filename, level="ERROR", event="circuit_open")
+                    raise
+                if not retryable or attempt == self.max_attempts - 1:
+                    raise
+                wait_time = self.backoff(attempt, e)
+                log_to_file(f"⚠️ Запит до {key} не вдався ({e}). Повторна спроба {attempt + 2}/{self.max_attempts} через {wait_time:.1f} сек.", log_filename, level="WARNING", event="rate_limited")
+                metrics.inc("sheets_retries_total", code=error_code(e))
+                if quota_exceeded:
+                    self.limiter.pause(wait_time)  # Квота спільна — чекають усі запити
+                else:
+                    await asyncio.sleep(wait_time)
+                continue
+            metrics.observe("sheets_request_seconds", time.perf_counter() - started_at)
+            metrics.inc("sheets_requests_total", code="200")
+            self.record_success(key)
+            return result
+
+    def status(self):
+        """ Стан запобіжників для /health """
+        now = time.monotonic()
+        with self.lock:
+            return {key: {"failures": circuit["failures"], "open_for": max(0, round(circuit["open_until"] - now))}
+                    for key, circuit in self.circuits.items()}
+
+sheets_quota = SheetsQuota(rate_limiter)
+
+# 🔹 Пули виконавців: потоки для запитів до API, (опційно) процеси для побудови XML
+# Процеси стартують через forkserver, а не fork: fork із потоку пулу успадкував би блокування
+# фонових потоків (логи, sheets-io, каталоги) і з'єднання SQLite у невизначеному стані.
+# Процеси пулів імпортують лише feed_builder (без побічних ефектів), а не main.py
+process_context = multiprocessing.get_context("forkserver")
+process_context.set_forkserver_preload(["feed_builder"])
+io_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="sheets")
+process_pools = {}  # Назва -> ProcessPoolExecutor; створюються при першому використанні
+process_pools_lock = threading.Lock()
+
+def get_process_pool(name, workers):
+    """ Спільний пул процесів із заданою назвою (створюється при першому зверненні) """
+    with process_pools_lock:
+        pool = process_pools.get(name)
+        if pool is None:
+            pool = process_pools[name] = ProcessPoolExecutor(max_workers=workers, mp_context=process_context)
+        return pool
+
+def discard_process_pool(name, pool):
+    """
+    Прибирає зламаний пул (процес завершився аварійно, напр. його вбив OOM killer):
+    BrokenProcessPool не минає сам, тож наступне звернення створить новий пул.
+    """
+    with process_pools_lock:
+        if process_pools.get(name) is pool:
+            del process_pools[name]
+    pool.shutdown(wait=False, cancel_futures=True)
 
-                processed_count += 1
+def get_xml_pool():
+    """ Пул процесів для побудови XML цілком (None, якщо XML_PROCESS_WORKERS не задано) """
+    return get_process_pool("xml", XML_PROCESS_WORKERS) if XML_PROCESS_WORKERS > 0 else None
 
-            ET.ElementTree(root).write(xml_file, encoding="utf-8", xml_declaration=True)
-            log_to_file(f"✅ XML {xml_file} збережено ({processed_count} товарів, пропущено {skipped_count})", log_filename)
-            return
+def get_chunk_pool():
+    """ Пул процесів для частин великих фідів (None, якщо доступне лише одне ядро) """
+    return get_process_pool("chunks", PARALLEL_BUILD_WORKERS) if PARALLEL_BUILD_WORKERS >= 2 else None
 
-        except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                retry_count += 1
-                wait_time = retry_count * 20
-                log_to_file(f"⚠️ Ліміт запитів перевищено для {supplier_name}. Повторна спроба {retry_count}/{max_retries} через {wait_time} сек.", log_filename)
-                time.sleep(wait_time)
-            else:
-                log_to_file(f"❌ Помилка доступу до {supplier_name}: {e}", log_filename)
-                return
+# 🔹 Авторизація Google Sheets (лінива: виконується при першому зверненні, а не під час імпорту)
+GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
+TOKEN_JSON = os.getenv("TOKEN_JSON")
+TOKEN_REFRESH_MARGIN = 300  # Оновлюємо токен заздалегідь, за 5 хвилин до закінчення
+GOOGLE_INIT_RETRY_INTERVAL = 60  # Пауза між спробами ініціалізації, якщо Google недоступний
+# Drive metadata — для дешевої перевірки modifiedTime; токен, виданий лише зі scope spreadsheets, слід перевипустити
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.metadata.readonly"]
 
-    log_to_file(f"❌ {supplier_name}: Всі {max_retries} спроби не вдалися. Пропускаємо.", log_filename)
+google_credentials = None
+google_credentials_lock = threading.Lock()
+app_state = {"started_at": time.time(), "ready_at": None, "google": "pending", "error": None}
 
+class GoogleAuthRequired(ValueError):
+    """ Токен не можна отримати чи оновити без участі людини — потрібен новий TOKEN_JSON (повтори не допоможуть) """
 
 
+def get_google_credentials():
+    """
+    Функція авторизації в Google (токен для запитів до Sheets і Drive API).
+    Інтерактивний вхід через браузер неможливий у фоновому завданні (порт 8080 уже зайняв сервер),
+    тож без придатного TOKEN_JSON з refresh_token одразу повідомляємо, що потрібен новий токен.
+    """
+    if not GOOGLE_CREDENTIALS or not TOKEN_JSON:
+        raise GoogleAuthRequired("❌ GOOGLE_CREDENTIALS або TOKEN_JSON відсутні!")
 
-def get_price_hash(sheet, log_filename):
+    try:
+        creds = Credentials.from_authorized_user_info(json.loads(TOKEN_JSON))
+    except ValueError as e:  # Немає refresh_token чи інших обов'язкових полів
+        raise GoogleAuthRequired(f"❌ TOKEN_JSON непридатний ({e}): видайте новий токен зі scope {', '.join(GOOGLE_SCOPES)}") from e
+
+    if not creds or not creds.valid:
+        if creds.refresh_token:
+            creds.refresh(GoogleRequest(requests.Session()))
+            log_to_file("🔄 Токен оновлено")
+        else:
+            raise GoogleAuthRequired(f"❌ TOKEN_JSON недійсний і не містить refresh_token: видайте новий токен зі scope {', '.join(GOOGLE_SCOPES)}")
+
+    return creds
+
+def token_expiring(creds):
+    """ True, якщо до закінчення токена лишилось менше TOKEN_REFRESH_MARGIN секунд """
+    expiry = getattr(creds, "expiry", None)  # naive UTC datetime у google-auth
+    if not expiry or not getattr(creds, "refresh_token", None):
+        return False
+    return (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() < TOKEN_REFRESH_MARGIN
+
+def get_credentials(rejected_token=None):
+    """
+    Повертає закешовані облікові дані (створює при першому виклику) зі свіжим токеном.
+    rejected_token — токен, на який API відповів 401: якщо він досі поточний, оновлюємо примусово
+    (кілька одночасних 401 з тим самим токеном оновлюють його лише раз).
     """
-    Генерує хеш для даних з Google Sheets, щоб визначити, чи змінилися вони.
+    global google_credentials
+    with google_credentials_lock:
+        if google_credentials is None:
+            google_credentials = get_google_credentials()
+        if rejected_token is not None and google_credentials.token == rejected_token:
+            google_credentials.refresh(GoogleRequest(requests.Session()))
+            log_to_file("🔄 Токен відхилено (401), оновлено", level="WARNING")
+        elif token_expiring(google_credentials):
+            google_credentials.refresh(GoogleRequest(requests.Session()))
+            log_to_file("🔄 Токен оновлено заздалегідь")
+        return google_credentials
+
+
+class AsyncSheetsClient:
     """
+    Асинхронний доступ до Google Sheets API v4 і Drive API v3:
+    - усі запити йдуть через один httpx.AsyncClient із пулом keep-alive з'єднань;
+    - клієнт живе у власному циклі подій в окремому потоці, тож запити багатьох постачальників
+      виконуються одночасно й не блокують ні цикл подій FastAPI, ні потоки побудови фідів;
+    - кожен запит проходить через SheetsQuota (квота, повтори, запобіжник);
+    - список аркушів таблиці кешується за sheet_id на SHEETS_METADATA_TTL секунд.
+    """
+    def __init__(self, quota, transport=None):
+        self.quota = quota
+        self.transport = transport  # Замінний транспорт httpx (бенчмарк підставляє таблиці в пам'яті)
+        self.http = None  # Створюється в циклі клієнта при першому запиті
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        self.credentials = None
+        self.metadata = {}  # sheet_id -> {"titles": [...], "fetched_at": monotonic}
+
+    def get_loop(self):
+        """ Цикл подій клієнта (запускається у фоновому потоці при першому зверненні) """
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="sheets-io", daemon=True).start()
+            return self.loop
+
+    def run(self, coro):
+        """ Виконує корутину в циклі клієнта й чекає на результат (з потоків пулу) """
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result()
+
+    async def run_async(self, coro):
+        """ Виконує корутину в циклі клієнта, не блокуючи цикл подій викликача (FastAPI) """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.get_loop()))
+
+    async def auth_headers(self, rejected_token=None):
+        if self.credentials is None or rejected_token is not None or token_expiring(self.credentials):
+            # Авторизація та оновлення токена — блокуючі виклики google-auth, тож виносимо їх з циклу подій
+            self.credentials = await asyncio.to_thread(get_credentials, rejected_token)
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def request_json(self, url, params):
+        if self.http is None:
+            limits = httpx.Limits(max_connections=SHEETS_HTTP_CONNECTIONS, max_keepalive_connections=SHEETS_HTTP_CONNECTIONS)
+            self.http = httpx.AsyncClient(transport=self.transport, timeout=SHEETS_HTTP_TIMEOUT, limits=limits)
+        headers = await self.auth_headers()
+        token = self.credentials.token  # Токен саме цього запиту (інші запити могли вже його оновити)
+        response = await self.http.get(url, params=params, headers=headers)
+        if response.status_code == 401:
+            # Токен відкликано або прострочено раніше строку — оновлюємо примусово й повторюємо запит один раз
+            response = await self.http.get(url, params=params, headers=await self.auth_headers(rejected_token=token))
+        if response.status_code >= 400:
+            raise SheetsAPIError(response)
+        return response.json()
+
+    async def get_json(self, key, url, params=None, log_filename=None):
+        """ GET-запит до таблиці key через квоту та повтори; повертає JSON або кидає SheetsAPIError """
+        return await self.quota.call(key, self.request_json, url, params, log_filename=log_filename)
+
+    async def get_titles(self, sheet_id, fresh=False, log_filename=None):
+        """ Назви аркушів таблиці: з кешу або (fresh=True, кеш застарів) одним запитом метаданих """
+        cached = self.metadata.get(sheet_id)
+        if not fresh and cached and time.monotonic() - cached["fetched_at"] < SHEETS_METADATA_TTL:
+            metrics.inc("sheets_metadata_cache_total", result="hit")
+            return cached["titles"]
+        metrics.inc("sheets_metadata_cache_total", result="miss")
+        metadata = await self.get_json(sheet_id, f"{SHEETS_API_URL}/{sheet_id}", {"fields": "sheets.properties.title"}, log_filename)
+        titles = [sheet["properties"]["title"] for sheet in metadata.get("sheets", [])]
+        self.metadata[sheet_id] = {"titles": titles, "fetched_at": time.monotonic()}
+        return titles
+
+    async def fetch_sheets(self, sheet_id, fresh=False, log_filename=None):
+        """
+        Завантажує всі аркуші таблиці: список аркушів (з кешу) + один values:batchGet.
+        Повертає список пар (назва аркуша, рядки).
+        """
+        titles = await self.get_titles(sheet_id, fresh, log_filename)
+        if not titles:
+            return []
+        try:
+            response = await self.get_json(sheet_id, f"{SHEETS_API_URL}/{sheet_id}/values:batchGet", {"ranges": [absolute_range_name(title) for title in titles]}, log_filename)
+        except SheetsAPIError as e:
+            if e.code != 400 or fresh:
+                raise
+            # Аркуш перейменували або видалили після кешування — перечитуємо список аркушів
+            return await self.fetch_sheets(sheet_id, True, log_filename)
+        value_ranges = response.get("valueRanges", [])
+        return [(title, value_range.get("values", [])) for title, value_range in zip(titles, value_ranges)]
+
+    async def fetch_records(self, sheet_id, title, log_filename=None):
+        """ Рядки аркуша як словники за заголовком (як worksheet.get_all_records у gspread) """
+        response = await self.get_json(sheet_id, f"{SHEETS_API_URL}/{sheet_id}/values/{urllib.parse.quote(absolute_range_name(title), safe='')}", log_filename=log_filename)
+        values = response.get("values")
+        if not values:
+            return []
+        rows = fill_gaps(values)
+        return to_records(rows[0], [numericise_all(row) for row in rows[1:]])
+
+    async def get_modified_time(self, sheet_id, log_filename=None):
+        """ modifiedTime таблиці з Drive API """
+        metadata = await self.get_json(sheet_id, f"{DRIVE_FILES_URL}/{sheet_id}", {"fields": "modifiedTime", "supportsAllDrives": "true"}, log_filename)
+        return metadata.get("modifiedTime")
+
+    def close(self):
+        """ Закриває пул з'єднань (при зупинці сервера) """
+        if self.http is not None:
+            self.run(self.http.aclose())
+            self.http = None
+
+sheets_api = AsyncSheetsClient(sheets_quota)
+
+async def init_google():
+    """ Авторизація та перевірка доступу до головної таблиці; стан видно через /health і /ready """
+    app_state["google"] = "initializing"
     try:
-        data = sheet.get_all_values()
-        data_str = json.dumps(data, sort_keys=True)  # Конвертуємо в JSON
-        return hashlib.md5(data_str.encode()).hexdigest()  # Повертаємо MD5-хеш
+        await sheets_api.run_async(sheets_api.get_titles(MASTER_SHEET_ID, fresh=True))
     except Exception as e:
-        log_to_file(f"⚠️ Помилка генерації хешу для {sheet.title}: {e}", log_filename)
-        return None
+        app_state["google"] = "error"
+        app_state["error"] = str(e)
+        raise
+    app_state["google"] = "ready"
+    app_state["error"] = None
+    app_state["ready_at"] = time.time()
 
-async def periodic_update():
+# 🔹 Фіди постачальників у XML_DIR (нормалізація, експортери й запис — у feed_builder.py)
+mimetypes.add_type("application/x-ndjson", ".jsonl")
+
+
+def feed_path(supplier_id, feed_format):
+    """ Шлях до фіду постачальника у вказаному форматі """
+    return os.path.join(XML_DIR, feed_filename(supplier_id, feed_format))
+
+
+# Інші файли з розширенням .xml у XML_DIR: дельти та фіди інших форматів із суфіксом .xml
+SECONDARY_XML_SUFFIXES = tuple(exporter.suffix for exporter in EXPORTERS.values() if exporter.suffix != XmlExporter.suffix and exporter.suffix.endswith(".xml")) + (".delta.xml",)
+
+def is_supplier_feed(name):
+    """ Чи є файл основним XML-фідом постачальника ({supplier_id}.xml) """
+    return name.endswith(XmlExporter.suffix) and not name.endswith(SECONDARY_XML_SUFFIXES)
+
+
+def write_atomic(target_path, chunks):
     """
-    Фоновий процес, який оновлює тільки ті XML-файли, які змінилися.
-    Лог-файл створюється один на весь цикл.
+    Потоково записує фрагменти у тимчасовий файл поруч із target_path
+    і атомарно підміняє ним цільовий файл — читачі ніколи не бачать напівзаписаний фід.
     """
-    while True:
-        log_filename = get_log_filename()  # Один лог-файл для всього запуску
-        log_to_file("🔄 [Auto-Update] Починаємо перевірку змін у Google Sheets...", log_filename)
+    fd, tmp_path = create_temp_file(target_path)
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-        retry_count = 0
-        max_retries = 5  
+# 🔹 Публікація фідів: хеш для ETag і попередньо стиснуті копії
+feed_meta_cache = {}  # {шлях: {"etag", "mtime_ns", "size"}}
 
-        while retry_count < max_retries:
-            try:
-                supplier_data = spreadsheet.worksheet("Sheet1").get_all_records()
-                break  # Вийти з циклу, якщо отримали дані без помилок
-
-            except gspread.exceptions.APIError as e:
-                if "429" in str(e):
-                    retry_count += 1
-                    wait_time = min(retry_count * 20, MAX_RETRY_TIME)
-                    log_to_file(f"⚠️ Перевищено ліміт API Google Sheets. Повторна спроба {retry_count}/{max_retries} через {wait_time} сек.", log_filename)
-                    await asyncio.sleep(wait_time)
-                else:
-                    log_to_file(f"❌ Помилка доступу до головної таблиці: {e}", log_filename)
-                    return
 
-        if retry_count == max_retries:
-            log_to_file("❌ Всі спроби доступу до Google Sheets провалилися. Пропускаємо цей цикл.", log_filename)
-            await asyncio.sleep(UPDATE_INTERVAL)
-            continue  
 
-        updated_suppliers = []
-        skipped_suppliers = []
-        batch_size = 5  
 
-        for i in range(0, len(supplier_data), batch_size):
-            batch = supplier_data[i:i + batch_size]
+def register_feed(path, etag):
+    """ Запам'ятовує хеш вмісту фіду (у пам'яті та в сховищі стану) для ETag """
+    stat = os.stat(path)
+    meta = {"etag": etag, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    feed_meta_cache[path] = meta
+    state_store.save_feed(os.path.basename(path), etag, stat.st_mtime_ns, stat.st_size)
+    output_catalog.update(path, etag=etag)
+    return meta
 
-            for supplier in batch:
-                supplier_id = str(supplier["Post_ID"])
-                supplier_name = supplier["Supplier Name"]
-                sheet_id = supplier["Google Sheet ID"]
 
-                if supplier_id in skipped_suppliers:
-                    log_to_file(f"⚠️ {supplier_name}: Пропускаємо через API-ліміт.", log_filename)
-                    continue
+def get_feed_meta(path):
+    """
+    Повертає метадані фіду для ETag. Хеш береться з кешу чи сховища стану;
+    лише для файлів, створених поза генератором, рахується один раз при першому запиті.
+    """
+    stat = os.stat(path)
+    meta = feed_meta_cache.get(path)
+    if meta is None:
+        meta = state_store.get_feed(os.path.basename(path))
+    if meta and meta["mtime_ns"] == stat.st_mtime_ns and meta["size"] == stat.st_size:
+        feed_meta_cache[path] = meta
+        return meta
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return register_feed(path, digest.hexdigest())
+
+
+def publish_feed(target_path, chunks):
+    """ Записує один фід (див. write_feeds) і реєструє його хеш для ETag """
+    for path, etag in write_feeds([target_path], ((chunk,) for chunk in chunks)).items():
+        register_feed(path, etag)
+
+
+def remove_feed(path):
+    """ Видаляє фід разом зі стиснутими копіями та метаданими """
+    for file_path in [path] + [compressed_path(path, encoding) for encoding in COMPRESSED_EXTENSIONS]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    feed_meta_cache.pop(path, None)
+    state_store.delete_feed(os.path.basename(path))
+    output_catalog.remove(path)
+
+
+def split_rows(data_sheets, chunk_rows=PARALLEL_CHUNK_ROWS):
+    """ Ділить рядки аркушів (без заголовків) на послідовні частини не більше chunk_rows рядків """
+    for data in data_sheets:
+        for start in range(1, len(data), chunk_rows):
+            yield data[start:start + chunk_rows]
+
+
+def compute_delta(previous, products):
+    """ Порівнює два знімки товарів за ID і повертає (нові, змінені, ID видалених) """
+    inserted = [product for product_id, product in products.items() if product_id not in previous]
+    updated = [product for product_id, product in products.items() if product_id in previous and previous[product_id] != product]
+    deleted = [product_id for product_id in previous if product_id not in products]
+    return inserted, updated, deleted
+
+def render_delta_xml(delta):
+    """ Серіалізує дельту у компактний XML: <delta><inserted/><updated/><deleted/></delta> """
+    yield "<?xml version='1.0' encoding='utf-8'?>\n"
+    yield f'<delta supplier="{xml_escape(delta["supplier_id"])}" version="{delta["version"]}" base_version="{delta["base_version"]}">'
+    for section in ("inserted", "updated"):
+        yield f"<{section}>"
+        for product in delta[section]:
+            yield render_product_xml(product)
+        yield f"</{section}>"
+    yield "<deleted>"
+    for product_id in delta["deleted"]:
+        yield f"<id>{xml_escape(product_id)}</id>"
+    yield "</deleted></delta>"
+
+def publish_delta(supplier_id, supplier_name, products, log_filename):
+    """
+    Порівнює нові товари з попереднім знімком і публікує {supplier_id}.delta.xml / .delta.json
+    поруч із повним фідом. Перша генерація лише зберігає знімок (версія 1).
+    """
+    version, previous = state_store.get_products(supplier_id)
+    if previous is None:
+        state_store.save_products(supplier_id, 1, products, supplier_name=supplier_name)
+        return
+
+    inserted, updated, deleted = compute_delta(previous, products)
+    if not (inserted or updated or deleted):
+        log_to_file(f"⏭️ {supplier_id}: Товари не змінились, дельту не створюємо", log_filename, supplier=supplier_name, event="delta_unchanged")
+        return
+
+    delta = {
+        "supplier_id": supplier_id,
+        "version": version + 1,
+        "base_version": version,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "inserted": inserted,
+        "updated": updated,
+        "deleted": deleted,
+    }
+    publish_feed(os.path.join(XML_DIR, f"{supplier_id}.delta.xml"), render_delta_xml(delta))
+    publish_feed(os.path.join(XML_DIR, f"{supplier_id}.delta.json"), [json.dumps(delta, ensure_ascii=False)])
+    state_store.save_products(supplier_id, version + 1, products, delta, supplier_name)
+    log_to_file(f"✅ Дельта {supplier_id} v{version + 1}: нових {len(inserted)}, змінених {len(updated)}, видалених {len(deleted)}", log_filename, supplier=supplier_name, event="delta_published", counts={"inserted": len(inserted), "updated": len(updated), "deleted": len(deleted)})
+
+
+def fetch_supplier_sheets(sheet_id, fresh=False, log_filename=None):
+    """
+    Завантажує всі аркуші таблиці постачальника через sheets_api: список аркушів береться з кешу
+    (fresh=True — перечитується), дані всіх аркушів — одним values:batchGet.
+    Повертає список пар (назва аркуша, рядки).
+    """
+    return sheets_api.run(sheets_api.fetch_sheets(sheet_id, fresh, log_filename))
 
-                columns = {
-                    "ID": supplier["ID Column"] if supplier["ID Column"] != "-" else None,
-                    "Name": supplier["Name Column"] if supplier["Name Column"] != "-" else None,
-                    "Stock": supplier["Stock Column"] if supplier["Stock Column"] != "-" else None,
-                    "Price": supplier["Price Column"] if supplier["Price Column"] != "-" else None,
-                    "SKU": supplier["SKU Column"] if supplier["SKU Column"] != "-" else None,
-                    "RRP": supplier["RRP Column"] if supplier["RRP Column"] != "-" else None,
-                    "Currency": supplier["Currency Column"] if supplier["Currency Column"] != "-" else None
-                }
+DRIVE_SCOPE_ERRORS = ("insufficientPermissions", "ACCESS_TOKEN_SCOPE_INSUFFICIENT")  # Причини 403, коли токену бракує доступу до Drive API
 
-                retry_count = 0
+def is_drive_scope_error(error):
+    """ 403 через обмеження самого токена (немає scope для Drive), а не через доступ до конкретної таблиці """
+    return error.code == 403 and any(reason in error.response.text for reason in DRIVE_SCOPE_ERRORS)
 
-                while retry_count < max_retries:
-                    try:
-                        sheet = client.open_by_key(sheet_id).sheet1
-                        await asyncio.sleep(random.uniform(2, 5))  
+def get_modified_time(sheet_id, log_filename):
+    """
+    Повертає modifiedTime таблиці з Drive API (дешева перевірка перед завантаженням даних).
+    Якщо токен не має доступу до Drive API, перевірка вимикається до перезапуску;
+    інші помилки (таблицю не знайдено чи не надано доступ) стосуються лише цієї таблиці — повертаємо None.
+    """
+    global drive_metadata_available
 
-                        new_hash = get_price_hash(sheet, log_filename) 
+    if not drive_metadata_available:
+        return None
+    try:
+        return sheets_api.run(sheets_api.get_modified_time(sheet_id, log_filename))
+    except SheetsAPIError as e:
+        if is_retryable(e):
+            raise
+        if not is_drive_scope_error(e):
+            log_to_file(f"⚠️ modifiedTime для {sheet_id} недоступний ({e}), зміни визначаються за хешем даних", log_filename, level="WARNING")
+            return None
+        drive_metadata_available = False
+        log_to_file(f"⚠️ Drive API недоступний ({e}), зміни визначаються лише за хешем даних. Перевипустіть TOKEN_JSON зі scope drive.metadata.readonly", log_filename)
+        return None
 
-                        if supplier_id in price_hash_cache and price_hash_cache[supplier_id] == new_hash:
-                            log_to_file(f"⏭️ {supplier_name}: Немає змін, пропускаємо...", log_filename)
-                            break  
+def get_price_hash(sheets_data):
+    """
+    Генерує хеш для всіх аркушів таблиці, щоб визначити, чи змінилися дані.
+    """
+    data_str = json.dumps(sheets_data, sort_keys=True)  # Конвертуємо в JSON
+    return hashlib.md5(data_str.encode()).hexdigest()  # Повертаємо MD5-хеш
 
-                        price_hash_cache[supplier_id] = new_hash  
+def get_config_hash(supplier_name, columns, formats):
+    """
+    Відбиток налаштувань постачальника, що впливають на вміст фідів: назва, колонки (після компіляції
+    в індекси, тож "b " і "B" — те саме) і формати. Зміна в "Sheet1" перебудовує фіди без змін у даних.
+    """
+    config_str = json.dumps({"name": supplier_name, "columns": compile_columns(columns), "formats": list(formats)}, sort_keys=True)
+    return hashlib.md5(config_str.encode()).hexdigest()
 
-                        create_xml(supplier_id, supplier_name, sheet_id, columns, log_filename)
+def create_xml(supplier_id, supplier_name, sheet_id, columns, log_filename, sheets_data=None, formats=DEFAULT_FORMATS):
+    """
+    Генерація фідів (XML та інших форматів з formats) з обробкою помилок API та поля наявності.
+    Якщо sheets_data вже завантажені (перевірка змін), повторно таблицю не читаємо.
+    Повертає True, якщо фіди успішно збережено.
+    """
+    log_to_file(f"📥 Обробка: {supplier_name} ({sheet_id})", log_filename, supplier=supplier_name, event="processing")
 
-                        updated_suppliers.append(supplier_name)
-                        break  
+    try:
+        if sheets_data is None:
+            with metrics.timer("xml_stage_seconds", stage="fetch", supplier=supplier_name):
+                sheets_data = fetch_supplier_sheets(sheet_id, log_filename=log_filename)
+    except SHEETS_ERRORS as e:
+        log_to_file(f"❌ Помилка доступу до {supplier_name}: {e}", log_filename, supplier=supplier_name, event="api_error")
+        return False
+
+    data_sheets = []
+    for title, data in sheets_data:
+        if len(data) < 2:
+            log_to_file(f"⚠️ Аркуш {title} порожній", log_filename, supplier=supplier_name, event="empty_sheet")
+            continue
+        data_sheets.append(data)
+
+    if not data_sheets:
+        log_to_file(f"⚠️ {supplier_name}: Немає даних у таблицях", log_filename, supplier=supplier_name, event="no_data")
+        return False
+
+    def data_rows():
+        """ Рядки всіх аркушів без заголовків, без копіювання в один великий список """
+        return itertools.chain.from_iterable(itertools.islice(data, 1, None) for data in data_sheets)
+
+    row_count = sum(len(data) - 1 for data in data_sheets)
+    log_debug = (lambda content: log_to_file(content, log_filename, "DEBUG")) if log_enabled("DEBUG") else None
+    chunk_pool = get_chunk_pool() if row_count >= PARALLEL_BUILD_THRESHOLD else None
+    pool_name, pool = ("chunks", chunk_pool) if chunk_pool else ("xml", get_xml_pool())
+
+    # CPU-частину за потреби виносимо в окремі процеси, щоб не тримати GIL
+    build_started_at = time.perf_counter()
+    result = None
+    try:
+        if chunk_pool:
+            # Великий постачальник: частини аркушів обробляються паралельно на всіх ядрах
+            log_to_file(f"⚙️ {supplier_name}: {row_count} рядків — паралельна побудова на {PARALLEL_BUILD_WORKERS} процесах", log_filename, supplier=supplier_name, event="parallel_build")
+            result = build_feeds(supplier_id, supplier_name, split_rows(data_sheets), columns, XML_DIR, formats, log_debug, pool=chunk_pool, chunks_in_flight=PARALLEL_CHUNKS_IN_FLIGHT)
+        elif pool:
+            result, messages = pool.submit(build_feeds_isolated, supplier_id, supplier_name, list(data_rows()), columns, XML_DIR, formats, debug=log_debug is not None).result()
+            for message in messages:
+                log_debug(message)
+    except BrokenProcessPool as e:
+        # Процес пулу впав (напр. OOM killer): пул замінюємо новим, а цього постачальника будуємо тут
+        discard_process_pool(pool_name, pool)
+        metrics.inc("process_pool_restarts_total", pool=pool_name)
+        log_to_file(f"⚠️ {supplier_name}: пул процесів зламано ({e}), будуємо фіди в поточному процесі", log_filename, level="WARNING", supplier=supplier_name, event="process_pool_broken")
+        build_started_at = time.perf_counter()
+    if result is None:
+        result = build_feeds(supplier_id, supplier_name, data_rows(), columns, XML_DIR, formats, log_debug)
+    products, counters, timings, etags = result
+    build_time = time.perf_counter() - build_started_at
+
+    saved = ", ".join(os.path.basename(path) for path in etags)
+    log_to_file(f"✅ Фіди {saved} збережено ({counters['processed']} товарів, пропущено {counters['skipped']})", log_filename, supplier=supplier_name, event="xml_saved", counts=counters)
+    get_run_logger(log_filename).count(supplier_name, **counters)
+
+    for stage, seconds in timings.items():
+        metrics.observe("xml_stage_seconds", seconds, stage=stage, supplier=supplier_name)
+    for result, amount in counters.items():
+        metrics.inc("xml_rows_total", amount, supplier=supplier_name, result=result)
+    # Фіди могли бути записані в пулі процесів — сховище стану та каталог оновлюємо тут, у головному процесі
+    for path, etag in etags.items():
+        register_feed(path, etag)
+        output_catalog.update(path, products=counters["processed"])
+    for feed_format in EXPORTERS:
+        stale_path = feed_path(supplier_id, feed_format)
+        if feed_format not in formats and os.path.exists(stale_path):
+            remove_feed(stale_path)  # Формат прибрали з налаштувань постачальника
+    if build_time > 0:
+        metrics.set("xml_rows_per_second", round((counters["processed"] + counters["skipped"]) / build_time), supplier=supplier_name)
+
+    publish_delta(supplier_id, supplier_name, products, log_filename)
+    return True
+
+
+def get_supplier_columns(supplier):
+    """ Формує словник колонок постачальника з рядка головної таблиці ("-" означає, що колонки немає) """
+    return {
+        "ID": supplier["ID Column"] if supplier["ID Column"] != "-" else None,
+        "Name": supplier["Name Column"] if supplier["Name Column"] != "-" else None,
+        "Stock": supplier["Stock Column"] if supplier["Stock Column"] != "-" else None,
+        "Price": supplier["Price Column"] if supplier["Price Column"] != "-" else None,
+        "SKU": supplier["SKU Column"] if supplier["SKU Column"] != "-" else None,
+        "RRP": supplier["RRP Column"] if supplier["RRP Column"] != "-" else None,
+        "Currency": supplier["Currency Column"] if supplier["Currency Column"] != "-" else None
+    }
+
+def get_supplier_formats(supplier, log_filename=None):
+    """ Формати фідів постачальника з колонки FORMATS_COLUMN (порожньо або "-" — лише xml) """
+    value = str(supplier.get(FORMATS_COLUMN, "")).strip().lower()
+    if not value or value == "-":
+        return DEFAULT_FORMATS
+    formats = []
+    for feed_format in re.split(r"[,;\s]+", value):
+        if feed_format in EXPORTERS and feed_format not in formats:
+            formats.append(feed_format)
+        elif feed_format and feed_format not in EXPORTERS:
+            log_to_file(f"⚠️ {supplier.get('Supplier Name')}: Невідомий формат фіду '{feed_format}'", log_filename, supplier=supplier.get("Supplier Name"), event="unknown_format")
+    return tuple(formats) or DEFAULT_FORMATS
+
+def refresh_supplier(supplier, log_filename, force=False):
+    """
+    Перевіряє зміни в таблиці одного постачальника та за потреби перебудовує XML.
+    force=True (ручний запуск) перебудовує XML навіть без змін.
+    Виконується в пулі потоків; повертає "updated", "rebuilt" (force без змін даних), "unchanged" або "failed".
+    """
+    supplier_id = str(supplier["Post_ID"])
+    supplier_name = supplier["Supplier Name"]
+    sheet_id = supplier["Google Sheet ID"]
+    columns = get_supplier_columns(supplier)
+    formats = get_supplier_formats(supplier, log_filename)
+    # Набір форматів змінився (новий фід ще не створено або лишився прибраний) — перебудовуємо навіть без змін даних
+    force = force or any(os.path.exists(feed_path(supplier_id, feed_format)) != (feed_format in formats) for feed_format in EXPORTERS)
+    # Так само, якщо в "Sheet1" змінили колонки чи назву: хеш даних і modifiedTime цього не бачать
+    config_hash = get_config_hash(supplier_name, columns, formats)
+    if not force and supplier_id in price_hash_cache and config_hash_cache.get(supplier_id) != config_hash:
+        log_to_file(f"⚙️ {supplier_name}: Налаштування постачальника змінилися, перебудовуємо фіди", log_filename, supplier=supplier_name, event="config_changed")
+        force = True
 
-                    except gspread.exceptions.APIError as e:
-                        if "429" in str(e):
-                            retry_count += 1
-                            wait_time = min(retry_count * 20, MAX_RETRY_TIME)
-                            log_to_file(f"⚠️ Перевищено ліміт API Google Sheets для {supplier_name}. Повторна спроба {retry_count}/{max_retries} через {wait_time} сек.", log_filename)
-                            await asyncio.sleep(wait_time)  
-                        else:
-                            log_to_file(f"❌ Помилка обробки {supplier_name}: {e}", log_filename)
-                            break  
+    try:
+        # 🔹 Спершу дешева перевірка modifiedTime, потім — одне завантаження всіх аркушів
+        modified_time = get_modified_time(sheet_id, log_filename)
+        if not force and modified_time and supplier_id in price_hash_cache and modified_time_cache.get(supplier_id) == modified_time:
+            metrics.inc("change_checks_total", result="modified_time")
+            log_to_file(f"⏭️ {supplier_name}: Таблиця не змінювалась, пропускаємо...", log_filename, supplier=supplier_name, event="unchanged")
+            return "unchanged"
+
+        with metrics.timer("xml_stage_seconds", stage="fetch", supplier=supplier_name):
+            sheets_data = fetch_supplier_sheets(sheet_id, force, log_filename)  # Ручний запуск бачить щойно додані аркуші
+    except CircuitOpenError as e:
+        log_to_file(f"🔌 {supplier_name}: {e}, пропускаємо...", log_filename, supplier=supplier_name, event="circuit_open")
+        return "failed"
+    except SHEETS_ERRORS as e:
+        log_to_file(f"❌ Помилка обробки {supplier_name}: {e}", log_filename, supplier=supplier_name, event="api_error")
+        return "failed"
+
+    with metrics.timer("xml_stage_seconds", stage="hash", supplier=supplier_name):
+        new_hash = get_price_hash(sheets_data)
+    data_changed = price_hash_cache.get(supplier_id) != new_hash
+    metrics.inc("change_checks_total", result="hash" if not data_changed else "changed" if supplier_id in price_hash_cache else "new")
+
+    if not force and not data_changed:
+        modified_time_cache[supplier_id] = modified_time
+        state_store.touch(supplier_id, modified_time)
+        log_to_file(f"⏭️ {supplier_name}: Немає змін, пропускаємо...", log_filename, supplier=supplier_name, event="unchanged")
+        return "unchanged"
+
+    if not create_xml(supplier_id, supplier_name, sheet_id, columns, log_filename, sheets_data, formats):
+        return "failed"
+
+    # Стан фіксуємо лише після успішної генерації, щоб невдалий XML перебудувався наступного циклу
+    price_hash_cache[supplier_id] = new_hash
+    modified_time_cache[supplier_id] = modified_time
+    config_hash_cache[supplier_id] = config_hash
+    state_store.save(supplier_id, new_hash, modified_time, config_hash, feed_path(supplier_id, formats[0]))
+    return "updated" if data_changed else "rebuilt"
+
+async def fetch_supplier_list(log_filename=None):
+    """ Завантажує список постачальників з головної таблиці (аркуш "Sheet1") одним запитом """
+    return await sheets_api.run_async(sheets_api.fetch_records(MASTER_SHEET_ID, "Sheet1", log_filename))
+
+# 🔹 Планувальник оновлень
+def get_supplier_priority(supplier):
+    """
+    Ручний пріоритет постачальника з колонки PRIORITY_COLUMN:
+    "high" — найчастіше, "low" — найрідше, число — хвилини між перевірками.
+    Повертає фіксований інтервал у секундах або None (адаптивний інтервал).
+    """
+    value = str(supplier.get(PRIORITY_COLUMN, "")).strip().lower()
+    if value == "high":
+        return MIN_UPDATE_INTERVAL
+    if value == "low":
+        return MAX_UPDATE_INTERVAL
+    try:
+        minutes = float(value.replace(",", "."))
+    except ValueError:
+        return None
+    return max(60.0, minutes * 60) if minutes > 0 else None
 
-                if retry_count == max_retries:
-                    log_to_file(f"❌ {supplier_name}: Всі {max_retries} спроби провалилися.", log_filename)
-                    skipped_suppliers.append(supplier_id)
+def spread_offset(supplier_id, interval):
+    """ Стабільний зсув у межах інтервалу, щоб постачальники рівномірно розподілялися в часі """
+    fraction = int(hashlib.md5(supplier_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return fraction * interval
 
-        log_to_file(f"✅ [Auto-Update] Оновлено {len(updated_suppliers)} постачальників, чекаємо наступний цикл...", log_filename)
 
-        cleanup_old_logs()  # Очищення логів старших за 7 днів перед кожним новим циклом
+class UpdateScheduler:
+    """
+    Черга перевірок постачальників (heap за часом наступної перевірки):
+    - інтервал кожного постачальника адаптується: зміна хешу — частіше, без змін — рідше
+      (у межах MIN_UPDATE_INTERVAL..MAX_UPDATE_INTERVAL);
+    - ручний пріоритет з головної таблиці фіксує інтервал;
+    - інтервали та час наступної перевірки зберігаються у StateStore і переживають перезапуск.
+    Використовується лише з циклу подій, тому без блокувань.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.entries = store.load_schedule()
+        self.heap = [(entry["next_run"], supplier_id) for supplier_id, entry in self.entries.items()]
+        heapq.heapify(self.heap)
+        self.suppliers = {}  # supplier_id -> рядок головної таблиці
+        self.synced_at = 0.0
+
+    def push(self, supplier_id):
+        heapq.heappush(self.heap, (self.entries[supplier_id]["next_run"], supplier_id))
+
+    def sync(self, supplier_data, now):
+        """ Оновлює список постачальників: нових додає в чергу, видалених прибирає """
+        self.suppliers = {str(supplier["Post_ID"]): supplier for supplier in supplier_data}
+        for supplier_id, supplier in self.suppliers.items():
+            override = get_supplier_priority(supplier)
+            entry = self.entries.get(supplier_id)
+            if entry is None:
+                interval = override or UPDATE_INTERVAL
+                # Ще не згенерований XML будуємо одразу, решту розкладаємо рівномірно в межах інтервалу
+                offset = spread_offset(supplier_id, interval) if supplier_id in price_hash_cache else 0
+                entry = self.entries[supplier_id] = {"interval": interval, "next_run": now + offset, "checks": 0, "changes": 0}
+                self.push(supplier_id)
+            elif override and override != entry.get("override") and entry["next_run"] > now + override:
+                entry["next_run"] = now + override
+                self.push(supplier_id)
+            entry["override"] = override
+        for supplier_id in set(self.entries) - set(self.suppliers):
+            del self.entries[supplier_id]
+        self.synced_at = now
+
+    def pop_due(self, now):
+        """ Повертає рядки постачальників, час перевірки яких настав """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            next_run, supplier_id = heapq.heappop(self.heap)
+            entry = self.entries.get(supplier_id)
+            # Застарілі записи heap (перепланування або видалений постачальник) пропускаємо
+            if entry is None or entry["next_run"] != next_run or supplier_id not in self.suppliers:
+                continue
+            entry["next_run"] = float("inf")  # Не видаємо повторно, доки перевірка не завершиться
+            due.append(self.suppliers[supplier_id])
+        return due
+
+    async def record(self, results, changed_ids, now):
+        """
+        Підлаштовує інтервали за результатами перевірок ({supplier_id: результат}) і планує наступні.
+        Розклад зберігається однією транзакцією в окремому потоці, щоб не блокувати цикл подій.
+        """
+        rows = []
+        for supplier_id, result in results.items():
+            entry = self.entries.get(supplier_id)
+            if entry is None:
+                continue
+            changed = supplier_id in changed_ids
+            entry["checks"] += 1
+            if changed:
+                entry["changes"] += 1
+            if entry.get("override"):
+                entry["interval"] = entry["override"]
+            elif changed or result == "unchanged":  # Перша генерація чи помилка інтервал не змінюють
+                factor = INTERVAL_SHRINK if changed else INTERVAL_GROWTH
+                entry["interval"] = min(MAX_UPDATE_INTERVAL, max(MIN_UPDATE_INTERVAL, entry["interval"] * factor))
+            entry["next_run"] = now + entry["interval"] * random.uniform(1 - SCHEDULE_JITTER, 1 + SCHEDULE_JITTER)
+            self.push(supplier_id)
+            rows.append((supplier_id, entry["interval"], entry["next_run"], entry["checks"], entry["changes"]))
+        if rows:
+            await asyncio.to_thread(self.store.save_schedules, rows)
+
+    def seconds_until_next(self, now):
+        """ Скільки спати до наступної перевірки (не довше SUPPLIER_LIST_TTL, щоб побачити нових постачальників) """
+        next_run = self.heap[0][0] if self.heap else now + SUPPLIER_LIST_TTL
+        return min(max(1.0, next_run - now), SUPPLIER_LIST_TTL)
+
+    def snapshot(self, now):
+        """ Стан черги для API: найближчі перевірки першими """
+        return sorted((
+            {
+                "supplier_id": supplier_id,
+                "interval": round(entry["interval"]),
+                "next_run_in": None if entry["next_run"] == float("inf") else round(entry["next_run"] - now),
+                "checks": entry["checks"],
+                "changes": entry["changes"],
+                "override": entry.get("override"),
+            }
+            for supplier_id, entry in self.entries.items()
+        ), key=lambda item: item["next_run_in"] if item["next_run_in"] is not None else -1)
+
+scheduler = UpdateScheduler(state_store)
+
+# 🔹 Черга завдань (спільна для ручних запусків і планувальника)
+class Job:
+    """ Завдання на перевірку/генерацію групи постачальників; стан видно через API """
+    def __init__(self, kind, supplier_ids, force, log_filename, owns_log):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind  # "manual" або "scheduled"
+        self.force = force
+        self.log_filename = log_filename
+        self.owns_log = owns_log  # Лог ручного завдання закриває сама черга
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.supplier_ids = list(dict.fromkeys(supplier_ids))
+        self.results = {}  # supplier_id -> "updated" / "rebuilt" / "unchanged" / "failed" / "cancelled"
+        self.cancelled = False
+        self.future = Future()  # Завершується підсумком; з async-коду чекаємо через asyncio.wrap_future
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "force": self.force,
+            "status": self.status,
+            "created_at": datetime.fromtimestamp(self.created_at).strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": round((self.finished_at or time.time()) - (self.started_at or self.created_at), 1),
+            "total": len(self.supplier_ids),
+            "done": len(self.results),
+            "results": dict(self.results),
+            "log": os.path.basename(self.log_filename),
+        }
+
+
+class JobQueue:
+    """
+    Єдина черга робіт по постачальниках:
+    - постачальник, який уже чекає в черзі або обробляється, не додається вдруге — нове завдання
+      приєднується до наявного запису і отримує його результат, тож повторні запуски не дублюють запити до API;
+    - один постачальник ніколи не обробляється двома потоками одночасно (блокування на постачальника);
+    - роботу виконує io_executor (не більше MAX_WORKERS постачальників паралельно);
+    - скасоване завдання знімає з черги своїх постачальників, які ще не почали оброблятися.
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()  # job_id -> Job
+        self.pending = {}  # supplier_id -> {"supplier", "force", "jobs"}
+        self.running = {}  # supplier_id -> {"supplier", "force", "jobs"} (зараз обробляється)
+        self.supplier_locks = collections.defaultdict(threading.Lock)
+
+    def submit(self, suppliers, kind="manual", force=False, log_filename=None):
+        """ Ставить постачальників у чергу й повертає Job; дублікати в черзі об'єднуються """
+        job = Job(kind, (str(supplier["Post_ID"]) for supplier in suppliers), force, log_filename or get_log_filename(), owns_log=kind == "manual")
+        with self.lock:
+            self.jobs[job.id] = job
+            self.trim_history()
+            for supplier in suppliers:
+                supplier_id = str(supplier["Post_ID"])
+                running = self.running.get(supplier_id)
+                if running and (running["force"] or not force):
+                    running["jobs"].append(job)
+                    continue
+                entry = self.pending.get(supplier_id)
+                if entry:
+                    entry["supplier"] = supplier
+                    entry["force"] = entry["force"] or force
+                    entry["jobs"].append(job)
+                    continue
+                self.pending[supplier_id] = {"supplier": supplier, "force": force, "jobs": [job]}
+                self.executor.submit(self.run_supplier, supplier_id)
+        if not job.supplier_ids:
+            self.finish(job)
+        return job
+
+    def trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(self.jobs) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def run_supplier(self, supplier_id):
+        """ Обробляє одного постачальника від імені всіх завдань, які на нього чекають """
+        with self.supplier_locks[supplier_id]:
+            with self.lock:
+                entry = self.pending.pop(supplier_id, None)
+                if not entry:
+                    return
+                cancelled = [job for job in entry["jobs"] if job.cancelled]
+                entry["jobs"] = [job for job in entry["jobs"] if not job.cancelled]
+                if entry["jobs"]:
+                    self.running[supplier_id] = entry
+            for job in cancelled:
+                self.record(job, supplier_id, "cancelled")
+            if not entry["jobs"]:
+                return
+
+            for job in entry["jobs"]:
+                if job.status == "queued":
+                    job.status = "running"
+                    job.started_at = time.time()
+            log_filename = entry["jobs"][0].log_filename
+            try:
+                result = refresh_supplier(entry["supplier"], log_filename, force=entry["force"])
+            except Exception as e:
+                log_to_file(f"❌ {entry['supplier'].get('Supplier Name')}: Неочікувана помилка: {e}", log_filename, supplier=entry["supplier"].get("Supplier Name"), event="unexpected_error")
+                result = "failed"
+            metrics.inc("supplier_refresh_total", supplier=entry["supplier"].get("Supplier Name"), result=result)
+            with self.lock:
+                jobs = self.running.pop(supplier_id)["jobs"]  # Разом із завданнями, що приєдналися під час обробки
+        for job in jobs:
+            self.record(job, supplier_id, result)
+
+    def record(self, job, supplier_id, result):
+        with self.lock:
+            job.results[supplier_id] = result
+            finished = len(job.results) == len(job.supplier_ids)
+        if finished:
+            self.finish(job)
+
+    def finish(self, job):
+        job.finished_at = time.time()
+        job.status = "cancelled" if job.cancelled else "done"
+        if job.owns_log:
+            counts = collections.Counter(job.results.values())
+            log_to_file(f"✅ [Manual] Завдання {job.id}: {dict(counts)}", job.log_filename, event="job_finished", counts=dict(counts))
+            close_run_logger(job.log_filename)
+        job.future.set_result(dict(job.results))
+
+    def cancel(self, job_id):
+        """ Скасовує завдання: постачальники, що ще в черзі, пропускаються; поточні доробляються """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job and not job.future.done():
+                job.cancelled = True
+                job.status = "cancelling"
+            return job.to_dict() if job else None
+
+    def get(self, job_id):
+        """ Стан завдання для API або None """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in reversed(self.jobs.values())]
+
+    def queued_ids(self):
+        with self.lock:
+            return set(self.pending) | set(self.running)
+
+job_queue = JobQueue(io_executor)
+
+def start_profiler():
+    """
+    Вмикає cProfile на весь цикл оновлення. З Python 3.12 профайлер один на інтерпретатор і бачить
+    усі потоки (пул постачальників теж), тож вмикаємо його один раз; None, якщо він уже активний.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+def dump_profile(profiler, log_filename):
+    """ Зберігає профіль циклу в .prof-файл у PROFILE_DIR (відкривається snakeviz / pstats) """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stats = pstats.Stats(profiler)
+    profile_path = os.path.join(PROFILE_DIR, os.path.basename(log_filename).replace("log_", "profile_").replace(".jsonl", ".prof"))
+    stats.dump_stats(profile_path)
+    log_to_file(f"🔬 Профіль циклу збережено: {profile_path}", log_filename, event="profile_saved")
+
+async def load_suppliers(log_filename, refresh=False):
+    """
+    Повертає {supplier_id: рядок головної таблиці}; список перечитується не частіше SUPPLIER_LIST_TTL
+    (refresh=True — примусово). Видалених постачальників прибирає зі сховища стану.
+    """
+    if refresh or time.time() - scheduler.synced_at >= SUPPLIER_LIST_TTL:
+        supplier_data = await fetch_supplier_list(log_filename)
+
+        # 🔹 Прибираємо зі сховища постачальників, яких видалили з головної таблиці
+        if supplier_data:
+            active_ids = [str(supplier["Post_ID"]) for supplier in supplier_data]
+            for supplier_id in await asyncio.to_thread(state_store.evict, active_ids):
+                price_hash_cache.pop(supplier_id, None)
+                modified_time_cache.pop(supplier_id, None)
+                config_hash_cache.pop(supplier_id, None)
+                log_to_file(f"🗑 Постачальника {supplier_id} видалено зі сховища стану", log_filename, supplier=supplier_id, event="evicted")
+        scheduler.sync(supplier_data, time.time())
+    return scheduler.suppliers
+
+async def run_update_cycle(check_all=False):
+    """
+    Один цикл оновлення: перевірка постачальників, час яких настав за планувальником
+    (check_all=True — усіх одразу). Робота йде через спільну job_queue, тож постачальник,
+    якого вже обробляє ручне завдання, не перевіряється вдруге.
+    Лог-файл створюється один на цикл і лише тоді, коли є що перевіряти.
+    Повертає підсумок {"updated", "unchanged", "failed", "seconds"} або None, якщо головна таблиця недоступна.
+    """
+    log_filename = get_log_filename()  # Один лог-файл для всього запуску
+    cycle_started_at = time.perf_counter()
+
+    try:
+        suppliers = await load_suppliers(log_filename, refresh=check_all)
+    except SHEETS_ERRORS as e:
+        log_to_file(f"❌ Помилка доступу до головної таблиці: {e}. Пропускаємо цей цикл.", log_filename, level="ERROR")
+        close_run_logger(log_filename)
+        return None
+
+    due = list(suppliers.values()) if check_all else scheduler.pop_due(time.time())
+    if not due:
+        close_run_logger(log_filename)
+        return {"updated": 0, "unchanged": 0, "failed": 0, "seconds": round(time.perf_counter() - cycle_started_at, 1)}
+
+    log_to_file(f"🔄 [Auto-Update] Перевіряємо зміни у Google Sheets: {len(due)} з {len(suppliers)} постачальників...", log_filename, event="cycle_started")
+    known_ids = set(price_hash_cache)  # Перша генерація не вважається зміною даних
+
+    profiler = start_profiler() if PROFILE_DIR else None
+    job = job_queue.submit(due, kind="scheduled", log_filename=log_filename)
+    try:
+        results = await asyncio.wrap_future(job.future)
+    finally:
+        if profiler:
+            profiler.disable()
+
+    updated_count = sum(1 for result in results.values() if result in ("updated", "rebuilt"))
+    unchanged_count = sum(1 for result in results.values() if result == "unchanged")
+    failed_count = len(results) - updated_count - unchanged_count
+    changed_ids = {supplier_id for supplier_id, result in results.items() if result == "updated" and supplier_id in known_ids}
+    await scheduler.record(results, changed_ids, time.time())
+
+    cycle_time = time.perf_counter() - cycle_started_at
+    metrics.observe("update_cycle_seconds", cycle_time)
+    if profiler:
+        dump_profile(profiler, log_filename)
+    summary = {"updated": updated_count, "unchanged": unchanged_count, "failed": failed_count, "seconds": round(cycle_time, 1)}
+    log_to_file(f"✅ [Auto-Update] Оновлено {updated_count} постачальників, без змін {unchanged_count}, з помилками {failed_count}. Тривалість циклу: {cycle_time:.1f} сек.", log_filename, event="cycle_finished", counts=summary)
+
+    close_run_logger(log_filename)
+    return summary
+
+async def periodic_update():
+    """
+    Фоновий процес: перевіряє постачальників у міру настання їхнього часу за планувальником
+    і спить до найближчої наступної перевірки.
+    """
+    while True:
+        await run_update_cycle()
+        if time.time() - log_catalog.scanned_at >= CATALOG_RESCAN_INTERVAL:
+            output_catalog.rescan()
+            log_catalog.rescan()
+        cleanup_old_logs()  # Очищення логів за віком і загальним розміром
+
+        await asyncio.sleep(scheduler.seconds_until_next(time.time()))
 
-        await asyncio.sleep(UPDATE_INTERVAL)
 
 
 
@@ -376,45 +2030,211 @@ async def periodic_update():
 app = FastAPI()
 templates = Jinja2Templates(directory="/app/templates")
 
+LISTING_SORTS = ("name", "mtime", "size", "products")
+
+def check_listing_sort(sort, order):
+    if sort not in LISTING_SORTS or order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"❌ sort: {', '.join(LISTING_SORTS)}; order: asc або desc")
+
+def listing_page(catalog, sort, order, page, per_page, name_filter=None):
+    """ Сторінка каталогу файлів для списків; дати — у зручному для читання вигляді """
+    check_listing_sort(sort, order)
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 1000)
+    total, items = catalog.page(sort, order == "desc", page, per_page, name_filter)
+    for item in items:
+        item["modified"] = datetime.fromtimestamp(item["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
+    return {"total": total, "page": page, "per_page": per_page, "has_next": page * per_page < total, "sort": sort, "order": order, "items": items}
+
 @app.get("/output/", response_class=HTMLResponse)
-def list_output_files(request: Request):
+def list_output_files(request: Request, sort: str = "name", order: str = "asc", page: int = 1, per_page: int = 100):
     """
-    Генерує HTML-сторінку зі списком файлів у папці /output/
+    Генерує HTML-сторінку зі списком файлів у папці /output/ (з каталогу в пам'яті, посторінково)
     """
-    try:
-        files = os.listdir(XML_DIR)
-        files = sorted(files)  # Сортуємо за алфавітом
-    except FileNotFoundError:
-        files = []
-    return templates.TemplateResponse("file_list.html", {"request": request, "files": files})
+    listing = listing_page(output_catalog, sort, order, page, per_page)
+    return templates.TemplateResponse(request, "file_list.html", {"request": request, "files": listing["items"], **listing})
+
+# 🔹 Віддача фідів з ETag, умовними запитами та попередньо стиснутими копіями
+def resolve_feed_path(filename):
+    """ Перевіряє ім'я фіду (без прихованих файлів і виходу за межі XML_DIR) і повертає шлях """
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Файл не знайдено")
+    file_path = os.path.join(XML_DIR, filename)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Файл не знайдено")
+    return file_path
+
+
+def accepted_encodings(request):
+    """ Кодування з Accept-Encoding, які клієнт приймає (q > 0) """
+    encodings = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def feed_not_modified(request, meta):
+    """ Перевіряє If-None-Match (пріоритетно) та If-Modified-Since """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            tag = tag.removeprefix("W/").strip('"')
+            if tag.split("-")[0] == meta["etag"]:
+                return True
+        return False
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(meta["mtime_ns"] / 1e9) <= since
+    return False
+
 
-app.mount("/output/", StaticFiles(directory=os.path.abspath(XML_DIR)), name="output")  
+def serve_feed(request, filename, as_attachment=False):
+    """
+    Віддає фід із сильним ETag на основі хешу вмісту.
+    На збіг ETag/If-Modified-Since відповідає 304, а стиснуті версії бере готовими з диска.
+    """
+    file_path = resolve_feed_path(filename)
+    meta = get_feed_meta(file_path)
+    headers = {
+        "ETag": f'"{meta["etag"]}"',
+        "Last-Modified": formatdate(meta["mtime_ns"] / 1e9, usegmt=True),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if feed_not_modified(request, meta):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    download_name = filename if as_attachment else None
+    encodings = accepted_encodings(request)
+
+    for encoding in COMPRESSED_EXTENSIONS:
+        if encoding not in encodings:
+            continue
+        encoded_path = compressed_path(file_path, encoding)
+        # Стиснута копія має бути не старшою за сам фід
+        if os.path.exists(encoded_path) and os.stat(encoded_path).st_mtime_ns >= meta["mtime_ns"]:
+            headers["ETag"] = f'"{meta["etag"]}-{encoding}"'
+            headers["Content-Encoding"] = encoding
+            return FileResponse(encoded_path, media_type=media_type, headers=headers, filename=download_name)
+
+    return FileResponse(file_path, media_type=media_type, headers=headers, filename=download_name)
+
+@app.api_route("/output/{filename}", methods=["GET", "HEAD"])
+def get_output_file(request: Request, filename: str):
+    return serve_feed(request, filename)
  
 
 @app.get("/XML_prices/google_sheet_to_xml/files")
-def list_files():
-    return {"files": [f for f in os.listdir(XML_DIR) if f.endswith(".xml")]}
-
-@app.get("/XML_prices/google_sheet_to_xml/download/{filename}")
-def download_file(filename: str):
-    file_path = os.path.join(XML_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, filename=filename)
-    raise HTTPException(status_code=404, detail="Файл не знайдено")
+def list_files(sort: str = "name", order: str = "asc", page: int = None, per_page: int = None):
+    """
+    Основні XML-фіди постачальників ({supplier_id}.xml) — без фідів інших форматів і дельт.
+    Без page/per_page повертає весь список, як і раніше; з ними — одну сторінку з метаданими.
+    """
+    if page is None and per_page is None:
+        check_listing_sort(sort, order)
+        _, items = output_catalog.page(sort, order == "desc", per_page=None, name_filter=is_supplier_feed)
+        return {"files": [item["name"] for item in items]}
+    listing = listing_page(output_catalog, sort, order, page or 1, per_page or 1000, name_filter=is_supplier_feed)
+    return {"files": [item["name"] for item in listing["items"]], **listing}
+
+@app.api_route("/XML_prices/google_sheet_to_xml/download/{filename}", methods=["GET", "HEAD"])
+def download_file(request: Request, filename: str):
+    return serve_feed(request, filename, as_attachment=True)
+
+@app.get("/XML_prices/google_sheet_to_xml/delta/{supplier_id}")
+def get_delta(supplier_id: str, since: int = 0):
+    """
+    Повертає зведену дельту товарів постачальника між версією since і поточною.
+    Якщо потрібних дельт уже немає в історії, повертає full_required — слід завантажити повний фід.
+    """
+    current, oldest, deltas = state_store.get_deltas(supplier_id, since)
+    if not current:
+        raise HTTPException(status_code=404, detail=f"Постачальника {supplier_id} не знайдено")
+
+    response = {"supplier_id": supplier_id, "since": since, "version": current, "full_required": False, "upserted": [], "deleted": []}
+    if since >= current:
+        return response
+    if since <= 0 or oldest is None or since < oldest - 1:
+        response["full_required"] = True
+        response["feed"] = f"/output/{supplier_id}.xml"
+        return response
+
+    # 🔹 Послідовно накладаємо дельти: пізніші зміни перекривають попередні
+    upserted = {}
+    deleted = set()
+    for delta in deltas:
+        for product in delta["inserted"] + delta["updated"]:
+            upserted[product["id"]] = product
+            deleted.discard(product["id"])
+        for product_id in delta["deleted"]:
+            upserted.pop(product_id, None)
+            deleted.add(product_id)
+
+    response["upserted"] = list(upserted.values())
+    response["deleted"] = sorted(deleted)
+    return response
+
+@app.get("/XML_prices/google_sheet_to_xml/products")
+def search_products(q: str = "", supplier: str = "", currency: str = "", in_stock: bool = None, sort: str = "price", page: int = 1, per_page: int = 50):
+    """ Посторінковий пошук у зведеному каталозі (назва / SKU / ID, фільтри за постачальником, валютою, наявністю) """
+    if sort not in ("price", "-price", "name"):
+        raise HTTPException(status_code=400, detail="❌ sort: price, -price або name")
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 500)
+    total, items = state_store.search_catalog(q, supplier or None, currency or None, in_stock, sort, page, per_page)
+    return {"total": total, "page": page, "per_page": per_page, "has_next": page * per_page < total, "items": items}
+
+@app.get("/XML_prices/google_sheet_to_xml/products/{code}")
+def get_product_offers(code: str, currency: str = "", in_stock: bool = None):
+    """ Усі пропозиції товару (за SKU або ID) від усіх постачальників, від найдешевшої """
+    offers = state_store.find_offers(code, currency or None, in_stock)
+    if not offers:
+        raise HTTPException(status_code=404, detail=f"❌ Товар {code} не знайдено")
+    return {"code": code, "offers": offers}
+
+@app.get("/XML_prices/google_sheet_to_xml/products/{code}/cheapest")
+def get_cheapest_offer(code: str, currency: str = "", in_stock: bool = True):
+    """ Найдешевша пропозиція товару; ціни в різних валютах не порівнюються — найдешевша для кожної валюти """
+    offers = state_store.find_offers(code, currency or None, in_stock)
+    if not offers:
+        raise HTTPException(status_code=404, detail=f"❌ Пропозицій для {code} не знайдено")
+    by_currency = {}
+    for offer in offers:  # Уже відсортовані за ціною
+        by_currency.setdefault(offer["currency"], offer)
+    return {"code": code, "cheapest": offers[0] if len(by_currency) == 1 else None, "by_currency": by_currency}
+
+@app.get("/XML_prices/google_sheet_to_xml/schedule")
+async def get_schedule():
+    """ Черга перевірок: інтервал і час до наступної перевірки кожного постачальника """
+    return {"suppliers": scheduler.snapshot(time.time())}
 
 @app.delete("/XML_prices/google_sheet_to_xml/delete/{filename}")
 def delete_file(filename: str):
     file_path = os.path.join(XML_DIR, filename)
     if os.path.exists(file_path):
-        os.remove(file_path)
+        remove_feed(file_path)
         return {"status": "success", "message": f"Файл {filename} видалено."}
     raise HTTPException(status_code=404, detail=f"Файл {filename} не знайдено.")
 
 @app.delete("/XML_prices/google_sheet_to_xml/delete_all")
 def delete_all_files():
-    files = os.listdir(XML_DIR)
+    files = [f for f in os.listdir(XML_DIR) if not f.startswith(".")]  # Не чіпаємо файли, які зараз записуються
     for file in files:
-        os.remove(os.path.join(XML_DIR, file))
+        remove_feed(os.path.join(XML_DIR, file))
     return {"status": "success", "message": "Всі файли у папці output видалено."}
 
 #@app.get("/logs/debug", response_class=HTMLResponse)
@@ -425,9 +2245,51 @@ def delete_all_files():
 
 
 
+async def start_background_updates():
+    """ Ініціалізує Google у фоні (з повторними спробами) і лише потім запускає оновлення XML """
+    while True:
+        try:
+            await init_google()
+            break
+        except GoogleAuthRequired as e:
+            log_to_file(f"{e}. Оновлення XML не запускаються до перезапуску з новим TOKEN_JSON.", level="ERROR")
+            return
+        except Exception as e:
+            log_to_file(f"❌ Не вдалося підключитися до Google: {e}. Повтор через {GOOGLE_INIT_RETRY_INTERVAL} сек.", level="ERROR")
+            await asyncio.sleep(GOOGLE_INIT_RETRY_INTERVAL)
+    log_to_file(f"✅ Google Sheets готовий за {app_state['ready_at'] - app_state['started_at']:.1f} сек.")
+    await periodic_update()
+
 @app.on_event("startup")
 async def startup_event():
-    asyncio.ensure_future(periodic_update())  # Запускаємо фоновий процес оновлення XML
+    # Сервер піднімається одразу; авторизація та оновлення XML йдуть у фоні
+    asyncio.ensure_future(start_background_updates())
+
+@app.on_event("shutdown")
+def shutdown_event():
+    sheets_api.close()
+
+@app.get("/health")
+def health():
+    """ Liveness: процес живий і віддає файли з /output незалежно від стану Google """
+    return {
+        "status": "ok",
+        "google": app_state["google"],
+        "error": app_state["error"],
+        "uptime": round(time.time() - app_state["started_at"], 1),
+        "circuits": sheets_quota.status(),
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """ Метрики генерації у текстовому форматі Prometheus """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/ready")
+def ready():
+    """ Readiness: 200 лише коли авторизація та головна таблиця готові """
+    status_code = 200 if app_state["google"] == "ready" else 503
+    return JSONResponse({"google": app_state["google"], "error": app_state["error"]}, status_code=status_code)
 
 
 # 🔹 Створення директорій для логів
@@ -435,74 +2297,104 @@ os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(os.path.join(LOG_DIR, "debug_logs"), exist_ok=True)  # Виправлення для вкладених папок
 
 @app.get("/logs/", response_class=HTMLResponse)
-def list_logs(request: Request):
+def list_logs(request: Request, sort: str = "mtime", order: str = "desc", page: int = 1, per_page: int = 100):
     """
-    Виводить список всіх файлів логів у вигляді HTML-таблиці
+    Виводить список файлів логів у вигляді HTML-таблиці (з каталогу в пам'яті, посторінково)
     """
-    try:
-        log_files = [
-            {"name": f, "size": os.path.getsize(os.path.join(LOG_DIR, f))}
-            for f in sorted(os.listdir(LOG_DIR), reverse=True) if f.startswith("log_") and f.endswith(".html")
-        ]
-    except FileNotFoundError:
-        log_files = []
-
-    return templates.TemplateResponse("log_list.html", {"request": request, "logs": log_files})
-
-
-app.mount("/logs/", StaticFiles(directory=os.path.abspath(LOG_DIR)), name="logs")
+    listing = listing_page(log_catalog, sort, order, page, per_page)
+    return templates.TemplateResponse(request, "log_list.html", {"request": request, "logs": listing["items"], **listing})
 
 
 @app.get("/logs/{filename}", response_class=HTMLResponse)
-def view_log(request: Request, filename: str):
+def view_log(request: Request, filename: str, page: int = 1, per_page: int = 200, tail: int = 0, supplier: str = "", level: str = ""):
     """
-    Відображає вміст лог-файлу у браузері через шаблон
+    Відображає сторінку лог-файлу у браузері через шаблон (HTML будується з JSONL-записів)
     """
-    safe_filename = urllib.parse.unquote(filename)
-    file_path = os.path.join(LOG_DIR, safe_filename)
+    safe_filename, file_path = resolve_log_path(filename)
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 1000)
+    tail = max(tail, 0)
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="❌ Файл не знайдено")
+    total_lines, entries, has_next = query_log(file_path, page, per_page, tail or None, supplier or None, level or None)
 
-    with open(file_path, "r", encoding="utf-8") as file:
-        log_content = file.read()
-
-    return templates.TemplateResponse("log_view.html", {
+    return templates.TemplateResponse(request, "log_view.html", {
         "request": request,
         "filename": safe_filename,
-        "log_content": log_content
+        "entries": entries,
+        "total_lines": total_lines,
+        "page": page,
+        "per_page": per_page,
+        "tail": tail,
+        "supplier": supplier,
+        "level": level,
+        "has_next": has_next
     })
 
 
-app.mount("/logs/", StaticFiles(directory=os.path.abspath(LOG_DIR)), name="logs")
+@app.get("/XML_prices/google_sheet_to_xml/logs/{filename}")
+def query_log_entries(filename: str, page: int = 1, per_page: int = 200, tail: int = 0, supplier: str = "", level: str = ""):
+    """ JSON API для логів: сторінки, хвіст і фільтри за постачальником/рівнем """
+    safe_filename, file_path = resolve_log_path(filename)
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 1000)
+    tail = max(tail, 0)
 
+    total_lines, entries, has_next = query_log(file_path, page, per_page, tail or None, supplier or None, level or None)
+    return {
+        "filename": safe_filename,
+        "total_lines": total_lines,
+        "page": page,
+        "per_page": per_page,
+        "has_next": has_next,
+        "entries": entries
+    }
 
 
-@app.post("/XML_prices/google_sheet_to_xml/generate")
-def generate():
-    log_filename = get_log_filename()
-    log_to_file("🚀 [Manual Start] Генерація XML вручну розпочата", log_filename)
-
-    def run_generation():
-        suppliers = spreadsheet.worksheet("Sheet1").get_all_records()
-
-        for supplier in suppliers:
-            supplier_id = str(supplier["Post_ID"])
-            supplier_name = supplier["Supplier Name"]
-            sheet_id = supplier["Google Sheet ID"]
-
-            columns = {
-                "ID": supplier["ID Column"] if supplier["ID Column"] != "-" else None,
-                "Name": supplier["Name Column"] if supplier["Name Column"] != "-" else None,
-                "Stock": supplier["Stock Column"] if supplier["Stock Column"] != "-" else None,
-                "Price": supplier["Price Column"] if supplier["Price Column"] != "-" else None,
-                "SKU": supplier["SKU Column"] if supplier["SKU Column"] != "-" else None,
-                "RRP": supplier["RRP Column"] if supplier["RRP Column"] != "-" else None,
-                "Currency": supplier["Currency Column"] if supplier["Currency Column"] != "-" else None
-            }
-
-            create_xml(supplier_id, supplier_name, sheet_id, columns, log_filename)
 
-    threading.Thread(target=run_generation).start()
+async def submit_generation(supplier_id=None):
+    """ Ставить ручну генерацію (усіх або одного постачальника) у спільну чергу """
+    if app_state["google"] != "ready":
+        raise HTTPException(status_code=503, detail="❌ Google Sheets ще не готовий")
+    log_filename = get_log_filename()
+    try:
+        suppliers = await load_suppliers(log_filename)
+        if supplier_id is not None and supplier_id not in suppliers:
+            suppliers = await load_suppliers(log_filename, refresh=True)  # Можливо, постачальника щойно додали
+    except SHEETS_ERRORS as e:
+        raise HTTPException(status_code=502, detail=f"❌ Помилка доступу до головної таблиці: {e}")
+    if supplier_id is not None:
+        if supplier_id not in suppliers:
+            raise HTTPException(status_code=404, detail=f"❌ Постачальника {supplier_id} не знайдено")
+        selected = [suppliers[supplier_id]]
+    else:
+        selected = list(suppliers.values())
+
+    log_to_file(f"🚀 [Manual Start] Генерація XML вручну розпочата: {len(selected)} постачальників", log_filename, event="manual_start")
+    job = job_queue.submit(selected, kind="manual", force=True, log_filename=log_filename)
+    return {"status": "Генерація XML запущена", **job_queue.get(job.id)}
 
-    return {"status": "Генерація XML запущена"}
+@app.post("/XML_prices/google_sheet_to_xml/generate")
+async def generate():
+    return await submit_generation()
+
+@app.post("/XML_prices/google_sheet_to_xml/generate/{supplier_id}")
+async def generate_supplier(supplier_id: str):
+    return await submit_generation(supplier_id)
+
+@app.get("/XML_prices/google_sheet_to_xml/jobs")
+def list_jobs():
+    return {"jobs": job_queue.list(), "queued_suppliers": sorted(job_queue.queued_ids())}
+
+@app.get("/XML_prices/google_sheet_to_xml/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="❌ Завдання не знайдено")
+    return job
+
+@app.post("/XML_prices/google_sheet_to_xml/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = job_queue.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="❌ Завдання не знайдено")
+    return job